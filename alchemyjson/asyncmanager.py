@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+    :copyright: 2015 Alpes Lasers SA, Neuchatel, Switzerland <samuele.chiesa@alpeslasers.ch>
+    :license: GNU AGPLv3+ or BSD
+
+    asyncio front end of the :class:`alchemyjson.manager.Manager`.
+
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import threading
+
+from sqlalchemy import event
+
+__author__ = 'chiesa'
+
+
+def interrupt_connection(dbapiConnection):
+    """Aborts the statement being executed on `dbapiConnection`, returns
+    whether the DBAPI driver supports it (``interrupt`` for sqlite3,
+    ``cancel`` for psycopg2).
+    """
+    for name in ('interrupt', 'cancel'):
+        method = getattr(dbapiConnection, name, None)
+        if method is not None:
+            method()
+            return True
+    return False
+
+
+def _current_loop():
+    """Returns the running event loop, else the event loop of the current
+    thread, for calls made outside of a coroutine."""
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Python < 3.7
+        loop = asyncio._get_running_loop()
+    except RuntimeError:
+        loop = None
+    return loop or asyncio.get_event_loop()
+
+
+class _Call(object):
+    # the connection is interrupted under the lock, so that it cannot have
+    # been released to the pool, and possibly reused, in the meantime
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.finished = False
+        self.dbapiConnection = None
+
+    def on_begin(self, session, transaction, connection):
+        with self.lock:
+            self.dbapiConnection = connection.connection
+            if self.cancelled:
+                interrupt_connection(self.dbapiConnection)
+
+    def cancel(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.cancelled = True
+            if self.dbapiConnection is not None:
+                interrupt_connection(self.dbapiConnection)
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            self.dbapiConnection = None
+
+
+class AsyncManager(object):
+    """
+    Exposes the select methods of a :class:`alchemyjson.manager.Manager` as
+    awaitables, so that they do not block the event loop.
+
+    Every call is executed by a bounded pool of worker threads in its own
+    session. When the awaiting task is cancelled (for instance by
+    :func:`asyncio.wait_for`), the statement being executed is aborted on
+    the database connection, which is then returned to the pool.
+
+    :param manager Manager: the manager whose models are queried
+    :param maxWorkers int: the maximum number of concurrently executed calls
+    :param loop: the event loop, defaults to the current event loop
+    """
+
+    def __init__(self, manager, maxWorkers=4, loop=None):
+        self.manager = manager
+        self._executor = ThreadPoolExecutor(maxWorkers)
+        self._loop = loop
+
+    def select(self, modelName, queryDict=None, page=1, maxPerPage=None,
+               timeout=None):
+        """Awaitable :meth:`alchemyjson.manager.Manager.select`, including
+        its functions path."""
+        return self.call(self.manager.select, modelName, queryDict, page,
+                         maxPerPage, timeout)
+
+    def select_by_unique(self, modelName, value, fieldName="id"):
+        """Awaitable :meth:`alchemyjson.manager.Manager.select_by_unique`."""
+        return self.call(self.manager.select_by_unique, modelName, value,
+                         fieldName)
+
+    def select_many(self, queries):
+        """Awaitable :meth:`alchemyjson.manager.Manager.select_many`, all the
+        selects being executed in the same session."""
+        return self.call(self.manager.select_many, queries)
+
+    def evaluate_subsets(self, modelName, subsets):
+        """Awaitable :meth:`alchemyjson.manager.Manager.evaluate_subsets`."""
+        return self.call(self.manager.evaluate_subsets, modelName, subsets)
+
+    def call(self, function, *args):
+        """Returns an :class:`asyncio.Future` of the result of
+        `function(*args)`, executed by a worker thread in a new session bound
+        to the manager for the duration of the call.
+        """
+        loop = self._loop or _current_loop()
+        call = _Call()
+        future = loop.run_in_executor(self._executor, self._execute, call,
+                                      function, args)
+
+        def on_done(future):
+            if future.cancelled():
+                call.cancel()
+        future.add_done_callback(on_done)
+        return future
+
+    def _execute(self, call, function, args):
+        if call.cancelled:
+            return None
+        local = self.manager._local
+        with closing(self.manager._new_session(read=True)) as session:
+            event.listen(session, 'after_begin', call.on_begin)
+            local.session = session
+            try:
+                return function(*args)
+            finally:
+                local.session = None
+                call.finish()
+
+    def close(self, wait=True):
+        """Shuts the worker threads down."""
+        self._executor.shutdown(wait=wait)
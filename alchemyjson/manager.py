@@ -7,20 +7,36 @@
 
 """
 
-from contextlib import closing
-from copy import deepcopy
+from contextlib import closing, contextmanager
+from copy import copy, deepcopy
 import decimal
 import math
 import json
 import datetime
-from sqlalchemy.exc import OperationalError
+from itertools import islice
+from collections import OrderedDict
+import threading
+import time
+from sqlalchemy import and_, or_, case, event
+from sqlalchemy.exc import DBAPIError, OperationalError
 import inspect as fn_inspect
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, configure_mappers
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.sql.functions import func
-from alchemyjson.utils.helpers import to_dict, evaluate_functions, count, primary_key_names, has_field, get_columns, \
-    get_relations, strings_to_dates
-from alchemyjson.utils.search import SearchParameters, create_query, OPERATORS, paginated
+from alchemyjson.utils.helpers import SerializerPlan, evaluate_functions, count, primary_key_names, has_field, get_columns, \
+    get_relations, strings_to_dates, to_value
+from alchemyjson.utils.search import SearchParameters, create_query, OPERATORS, paginated, \
+    get_pagination, create_filters
+from alchemyjson.utils.cache import SelectCache, SingleFlight, Prefetcher, canonical_query, \
+    query_shape, query_tables, model_tables
+from alchemyjson.utils.bulk import check_keys, chunks, insert_rows, upsert_rows
+from alchemyjson.utils.registry import model_info
+from alchemyjson.utils.sampling import sample_keys, IN_BATCH_SIZE
+from alchemyjson.utils.timeout import current_deadline, deadline, enforce_timeouts, \
+    use_deadline
+from alchemyjson.utils.sharding import ShardedModel, SortKey, merge_sorted, shard_functions, \
+    combine_functions
 
 __author__ = 'chiesa'
 
@@ -41,6 +57,33 @@ class MyJsonEncoder(json.JSONEncoder):
             return super(MyJsonEncoder, self).default(obj)
 
 
+class ReadOnlyError(Exception):
+    """Raised when writing within a read only
+    :meth:`Manager.session_scope`."""
+
+
+class QueryTimeout(Exception):
+    """Raised when a select is aborted by the database because its timeout
+    elapsed, see :meth:`Manager.select`."""
+
+
+class _Scope(object):
+
+    def __init__(self, readOnly):
+        self.readOnly = readOnly
+
+
+def _refuse_flush(session, flush_context, instances):
+    raise ReadOnlyError('flushes are not allowed in a read only scope')
+
+
+def _thread_pool(processes):
+    """Returns a new :class:`multiprocessing.pool.ThreadPool`, the module
+    being slow to import it is only loaded when needed."""
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(processes)
+
+
 class Manager(object):
 
     NULL_RESULT = dict(num_results=0,
@@ -48,6 +91,10 @@ class Manager(object):
                        total_pages=0,
                        page=1)
 
+    #: The maximum number of query shapes whose timeouts are counted per
+    #: model, the others are counted together under ``"other"``
+    MAX_TIMEOUT_SHAPES = 1000
+
     def __init__(self, dbConnection, maxResultsPerPage=100,
                  encoder=None):
         self.dbConnection = dbConnection
@@ -57,29 +104,677 @@ class Manager(object):
         if self._encoder is None:
             self._encoder = MyJsonEncoder()
         self._maxResultsPerPage = maxResultsPerPage
+        self.modelCacheTtl = {}
+        self.shardedModels = {}
+        self.cache = None
+        self.coalescer = None
+        self.prefetcher = None
+        self._local = threading.local()
+        self._shapes = None
+        self._maxShapes = 0
+        self._shapesLock = threading.Lock()
+        self.modelTimeouts = {}
+        self._timeouts = {}
+        self._timeoutsLock = threading.Lock()
+        self._timeoutsEnforced = False
+
+    def add_model(self, model, name=None, toDictKargs=None, cacheTtl=None,
+                  shards=None, shardBy=None, shardKey=None, timeout=None):
+        """
+        Registers `model` within the Manager.
+
+        A model whose rows are split across several databases is registered
+        with its `shards`: :meth:`select` then prunes the shards by the
+        filters on the `shardBy` field, queries the remaining ones
+        concurrently and merges their results (see :meth:`_select_sharded`).
 
-    def add_model(self, model, name=None, toDictKargs=None):
+        :param model: the SQLAlchemy declarative model class
+        :param name str: the name of the model within the Manager, defaults
+            to the name of the mapped table
+        :param toDictKargs dict: the default keyword arguments passed to
+            :func:`alchemyjson.utils.helpers.to_dict` when serializing
+            instances of the model
+        :param cacheTtl float: the time to live in seconds of the cached
+            responses for this model, defaults to the ttl of the cache
+            (see :meth:`enable_cache`)
+        :param shards dict: a dictionary mapping shard names to the database
+            connections holding the rows of the model
+        :param shardBy str: the name of the attribute the rows are sharded by
+        :param shardKey: a callable returning the name of the shard holding
+            the rows with a given value of the `shardBy` attribute, defaults
+            to the identity
+        :param timeout float: the default timeout in seconds of the selects
+            of the model, see :meth:`select`
+
+        The metadata of the model used by the queries (see
+        :func:`alchemyjson.utils.registry.model_info`) is computed on first
+        use, or by :meth:`prepare`.
+        """
+        if shards is not None and not shardBy:
+            raise ValueError('the shardBy attribute of a sharded model is required')
         if not name:
             name = inspect(model).mapped_table.name
         if name in self.models:
             raise ValueError('model with name {0} already added'.format(name))
         self.models[name] = model
         self.modelDictKargs[name] = toDictKargs or {}
+        if cacheTtl is not None:
+            self.modelCacheTtl[name] = cacheTtl
+        if timeout is not None:
+            self.modelTimeouts[name] = timeout
+        if shards is not None:
+            self.shardedModels[name] = ShardedModel(shards, shardBy, shardKey)
+            self._timeoutsEnforced = False
+
+    def add_all_from_database(self, include=None, exclude=None, snapshot=None,
+                              toDictKargs=None):
+        """
+        Reflects the tables of the database into mapped classes, by means of
+        :mod:`sqlalchemy.ext.automap`, and registers them with their table
+        names. The tables without primary key and the tables whose name is
+        already registered are skipped.
+
+        :param include list: the names of the reflected tables, defaults to
+            all the tables
+        :param exclude list: the names of the tables not to be reflected
+        :param snapshot str: the path of a file where the reflected schema is
+            saved, so that later calls load it instead of reflecting the
+            database as long as the schema fingerprint does not change, see
+            :func:`alchemyjson.utils.reflection.reflect_metadata`
+        :param toDictKargs dict: the default serialization keyword arguments
+            of the models, see :meth:`add_model`
+        :return dict: a dictionary mapping the names of the registered models
+            to their classes
+        """
+        from sqlalchemy.ext.automap import automap_base
+        from alchemyjson.utils.reflection import reflect_metadata
+        with closing(self.dbConnection.get_session()) as session:
+            engine = session.get_bind()
+        metadata = reflect_metadata(engine, include, exclude, snapshot)
+        base = automap_base(metadata=metadata)
+        base.prepare()
+        added = {}
+        for model in base.classes:
+            name = model.__table__.name
+            if name not in self.models:
+                self.add_model(model, name=name, toDictKargs=toDictKargs)
+                added[name] = model
+        return added
+
+    def prepare(self):
+        """
+        Computes the metadata of all the registered models, which is
+        otherwise computed on their first use, so that the first queries
+        do not pay for it.
+        """
+        configure_mappers()
+        for model in self.models.values():
+            model_info(model)
+
+    def warmup(self, path=None, connections=None):
+        """
+        Removes the latency of the first requests after a start: configures
+        the mappers and computes the metadata of the models (see
+        :meth:`prepare`), opens the connections of the pools, then executes
+        the default select of every registered model (a page of one row)
+        and the selects of the query shapes read from the file `path` (see
+        :meth:`save_shapes`), so that their statements are compiled. The
+        selects bypass the response cache.
+
+        :param path str: the path of a JSON file of query shapes, a list of
+            ``[modelName, queryDict, page, maxPerPage]`` items
+        :param connections int: the number of connections opened per engine,
+            defaults to the size of its pool
+        :return dict: a dictionary of the form::
+
+               {
+                 "mappers": {"seconds": 0.21},
+                 "connections": {"seconds": 0.05, "opened": 5},
+                 "models": {"seconds": 0.12, "count": 12},
+                 "shapes": {"seconds": 0.34, "count": 40, "failed": 0}
+               }
+            where ``failed`` is the number of shapes whose select raised an
+            exception, for instance because the model is not registered any
+            longer.
+        """
+        report = {}
+        start = time.time()
+        self.prepare()
+        report['mappers'] = dict(seconds=time.time() - start)
+        start = time.time()
+        opened = 0
+        for engine in self._engines():
+            opened += self._open_connections(engine, connections)
+        report['connections'] = dict(seconds=time.time() - start, opened=opened)
+        start = time.time()
+        for modelName in self.models:
+            self._select(modelName, {}, 1, 1)
+        report['models'] = dict(seconds=time.time() - start,
+                                count=len(self.models))
+        start = time.time()
+        shapes = []
+        if path is not None:
+            with open(path) as f:
+                shapes = json.load(f)
+        failed = 0
+        for shape in shapes:
+            try:
+                self._select(*self._select_args(*shape))
+            except Exception:
+                failed += 1
+        report['shapes'] = dict(seconds=time.time() - start,
+                                count=len(shapes), failed=failed)
+        return report
+
+    def _engines(self):
+        """Returns the list of the engines of the database connections,
+        including the replicas and the shards."""
+        connections = [self.dbConnection]
+        for sharded in self.shardedModels.values():
+            connections.extend(sharded.connections.values())
+        engines = []
+        for connection in connections:
+            if hasattr(connection, 'replicas'):
+                candidates = [connection.primary] + connection.replicas
+            else:
+                with closing(connection.get_session()) as session:
+                    candidates = [session.get_bind()]
+            engines.extend(e for e in candidates if e not in engines)
+        return engines
+
+    def _open_connections(self, engine, number=None):
+        """Opens `number` connections of `engine` at once, defaults to the
+        size of its pool, and returns them to the pool."""
+        if number is None:
+            number = getattr(engine.pool, 'size', 1)
+            if callable(number):
+                number = number()
+        opened = []
+        try:
+            for i in range(max(number, 1)):
+                opened.append(engine.connect())
+        finally:
+            for connection in opened:
+                connection.close()
+        return len(opened)
+
+    def enable_shape_recording(self, maxShapes=1000):
+        """
+        Starts recording the distinct query shapes passed to :meth:`select`,
+        at most `maxShapes`, to be saved by :meth:`save_shapes` and replayed
+        by :meth:`warmup`.
+        """
+        with self._shapesLock:
+            if self._shapes is None:
+                self._shapes = OrderedDict()
+            self._maxShapes = maxShapes
+
+    def disable_shape_recording(self):
+        """Stops recording and drops the recorded query shapes."""
+        with self._shapesLock:
+            self._shapes = None
+
+    def save_shapes(self, path):
+        """Writes the recorded query shapes to the JSON file `path`, see
+        :meth:`warmup`, and returns their number."""
+        with self._shapesLock:
+            shapes = list((self._shapes or {}).values())
+        with open(path, 'w') as f:
+            f.write(self.to_json(shapes))
+        return len(shapes)
+
+    def _record_shape(self, modelName, queryDict, maxPerPage):
+        key = (modelName, canonical_query(queryDict), maxPerPage)
+        with self._shapesLock:
+            shapes = self._shapes
+            if shapes is not None and key not in shapes \
+                    and len(shapes) < self._maxShapes:
+                shapes[key] = [modelName, queryDict, 1, maxPerPage]
+
+    def enable_cache(self, maxEntries=1000, maxBytes=64 * 1024 * 1024, ttl=60,
+                     compress=False):
+        """
+        Enables caching of the :meth:`select` responses.
+
+        Responses are cached per model name, queryDict, page and maxPerPage.
+        The cache is invalidated whenever a SQLAlchemy session flushes
+        changes to the tables of the model or to the tables of the relations
+        used in the ``to_dict.deep``, ``joinedload`` or ``filters``
+        specifications. Cached responses are stored pickled, thus a cache
+        hit returns a copy equal to the response of a miss.
+
+        :param maxEntries int: the maximum number of cached responses
+        :param maxBytes int: the maximum total size of the cached responses
+        :param ttl float: the default time to live in seconds of a cached
+            response, None for no expiration
+        :param compress bool: whether the cached responses are zlib
+            compressed
+        :return SelectCache: the cache, exposing the hit, miss and eviction
+            statistics through its ``stats`` method
+        """
+        self.disable_cache()
+        self.cache = SelectCache(maxEntries=maxEntries, maxBytes=maxBytes,
+                                 ttl=ttl, compress=compress)
+        self.cache.attach()
+        return self.cache
+
+    def disable_cache(self):
+        """Disables and drops the cache of the select responses."""
+        if self.cache is not None:
+            self.cache.detach()
+            self.cache = None
+
+    def enable_coalescing(self):
+        """
+        Enables the coalescing of identical concurrent selects: while a
+        :meth:`select` is being executed, the other calls with the same
+        model name, queryDict, page and maxPerPage wait for it and return
+        a copy of its response instead of querying the database again.
+
+        :return SingleFlight: the coalescer, exposing the number of executed
+            and collapsed selects through its ``stats`` method
+        """
+        if self.coalescer is None:
+            self.coalescer = SingleFlight()
+        return self.coalescer
+
+    def disable_coalescing(self):
+        """Disables the coalescing of identical concurrent selects."""
+        self.coalescer = None
+
+    def enable_prefetch(self, workers=2, maxPending=16, maxEntries=256,
+                        maxBytes=16 * 1024 * 1024, ttl=10):
+        """
+        Enables the read-ahead of the next page: after serving a page of
+        paginated rows, :meth:`select` schedules the select of the following
+        page with the same queryDict and maxPerPage in a background thread,
+        and serves it from memory if it is requested before `ttl` seconds.
+        The prefetched pages are invalidated as the cached responses, see
+        :meth:`enable_cache`, and, as them, are returned as copies equal to
+        the responses of the live selects.
+
+        :param workers int: the number of background threads
+        :param maxPending int: the maximum number of pages being prefetched,
+            further pages are not prefetched
+        :param maxEntries int: the maximum number of prefetched pages
+        :param maxBytes int: the maximum total size of the prefetched pages
+        :param ttl float: the time to live in seconds of a prefetched page
+        :return Prefetcher: the prefetcher, exposing the hit rate and the
+            number of wasted prefetches through its ``stats`` method
+        """
+        self.disable_prefetch()
+        self.prefetcher = Prefetcher(workers=workers, maxPending=maxPending,
+                                     maxEntries=maxEntries, maxBytes=maxBytes,
+                                     ttl=ttl)
+        return self.prefetcher
+
+    def disable_prefetch(self):
+        """Disables the read-ahead and drops the prefetched pages."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
 
     def get_model(self, modelName):
         return self.models[modelName]
 
     def select_by_unique(self, modelName, value, fieldName="id"):
+        if modelName in self.shardedModels:
+            return self._select_sharded(modelName,
+                                        {'filters': [{'name': fieldName,
+                                                      'op': 'eq',
+                                                      'val': value}],
+                                         'single': True}, 1, 0)
         model = self.get_model(modelName)
-        with closing(self.dbConnection.get_session()) as session:
-            inst = session.query(model).filter(getattr(model, fieldName) == value).\
-                            one()
-            return to_dict(inst, **self.modelDictKargs[modelName])
+        with self._session(read=True) as session:
+            plan = SerializerPlan(model, self.modelDictKargs[modelName])
+            q = session.query(model).filter(getattr(model, fieldName) == value)
+            return plan.to_dict(plan.apply(q).one())
+
+    def evaluate_subsets(self, modelName, subsets):
+        """
+        Evaluates several sets of functions, each over its own subset of
+        the rows of the table corresponding to modelName, in a single
+        statement using conditional aggregates.
+
+        :param modelName str: the name of the model within the Manager
+        :param subsets dict: a dictionary mapping a subset name to a
+            dictionary of the form::
+
+                {
+                  "filters": [{"name": "status", "op": "eq", "val": "open"}, ...],
+                  "disjunction": False,
+                  "functions": [{"name": "count", "field": "id"}, ...]
+                }
+            where ``filters`` and ``disjunction`` select the rows of the
+            subset as in :meth:`select` and ``functions`` are the functions
+            to be evaluated on them.
+        :return dict: a dictionary of the form::
+
+               {
+                 "open": {"count__id": 3},
+                 "closed": {"count__id": 5, "avg__duration": 12.5}
+               }
+        """
+        model = self.get_model(modelName)
+        self._check_unsharded(modelName)
+        subsetNames = []
+        funcnames = []
+        processed = []
+        conditions = []
+        for subsetName, subset in subsets.items():
+            sp = SearchParameters.from_dictionary(subset)
+            filters = create_filters(model, sp)
+            condition = sp.junction(*filters) if filters else None
+            conditions.append(condition)
+            for function in subset.get('functions') or []:
+                funcname, funcobj = self._function_column(model, function,
+                                                          condition)
+                subsetNames.append(subsetName)
+                funcnames.append(funcname)
+                processed.append(funcobj)
+        result = dict((subsetName, {}) for subsetName in subsets)
+        if not processed:
+            return result
+        with self._session(read=True) as session:
+            query = session.query(*processed)
+            # restrict the scan to the rows belonging to at least a subset
+            if all(c is not None for c in conditions):
+                query = query.filter(or_(*conditions))
+            evaluated = self._run_functions(query.one)
+        for subsetName, funcname, value in zip(subsetNames, funcnames,
+                                               evaluated):
+            result[subsetName][funcname] = value
+        return result
+
+    @contextmanager
+    def _session(self, read=False):
+        """Yields the session bound to the current thread if any, or else
+        a new session which is closed on exit, see :meth:`_new_session`.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            yield session
+            return
+        with closing(self._new_session(read)) as session:
+            yield session
+
+    def _new_session(self, read=False):
+        """Returns a new session of the database connection. If `read` is
+        True and the connection routes the reads to replicas (see
+        :class:`alchemyjson.utils.connection.RoutingConnection`), the session
+        is obtained from its ``get_read_session`` method.
+        """
+        if read:
+            get_read_session = getattr(self.dbConnection, 'get_read_session',
+                                       None)
+            if get_read_session is not None:
+                return get_read_session()
+        return self.dbConnection.get_session()
+
+    @contextmanager
+    def session_scope(self, readOnly=False):
+        """
+        Returns a context manager within which all the calls of the Manager
+        made by the current thread share the same session and database
+        transaction, as a unit of work::
+
+            with manager.session_scope() as m:
+                m.select('employees')
+                m.update('employees', queryDict, {'surname': 'x'})
+
+        The transaction is committed on exit, or rolled back if an exception
+        is raised. The writes are flushed rather than committed by the write
+        methods, and :meth:`commit` and :meth:`rollback` may be called
+        explicitly. The selects bypass the response cache and the
+        coalescing. Nested scopes join the outermost one. A scope reads its
+        own writes, when the reads are routed to replicas it uses the
+        primary unless it is read only.
+        Outside of a scope, every call uses its own session.
+
+        :param readOnly bool: if True, the write methods and the flushes
+            of the session raise :exc:`ReadOnlyError` and the transaction is
+            rolled back on exit
+        """
+        if getattr(self._local, 'scope', None) is not None:
+            if readOnly is False:
+                self._check_writable()
+            yield self
+            return
+        if getattr(self._local, 'session', None) is not None:
+            raise RuntimeError('a session is already bound to this thread')
+        with closing(self._new_session(read=readOnly)) as session:
+            if readOnly:
+                event.listen(session, 'before_flush', _refuse_flush)
+            self._local.session = session
+            self._local.scope = _Scope(readOnly)
+            try:
+                yield self
+                if readOnly:
+                    session.rollback()
+                else:
+                    session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                self._local.session = None
+                self._local.scope = None
+
+    def commit(self):
+        """Commits the transaction of the current :meth:`session_scope`."""
+        self._check_writable()
+        self._scope_session().commit()
+
+    def rollback(self):
+        """Rolls back the transaction of the current :meth:`session_scope`."""
+        self._scope_session().rollback()
+
+    def _scope_session(self):
+        if getattr(self._local, 'scope', None) is None:
+            raise RuntimeError('not within a session scope')
+        return self._local.session
+
+    def select_many(self, queries, workers=None):
+        """
+        Issues several selects, see :meth:`select`.
+
+        By default all the selects are executed in the same session and
+        database transaction, bypassing the cache but within the timeouts of
+        the models (see :meth:`add_model`), so that they see a
+        consistent snapshot of the database. On PostgreSQL and MySQL the
+        transaction isolation level is set to REPEATABLE READ to this end,
+        on SQLite, where the driver begins no transaction before a SELECT,
+        the transaction is begun explicitly (the writes of the other
+        connections are then blocked until the selects are done, unless the
+        database is in WAL mode).
+
+        :param queries list: a list of tuples of the form
+            ``(modelName, queryDict, page, maxPerPage)``, where the trailing
+            items may be omitted
+        :param workers int: if given, the selects are instead independently
+            executed by a pool of at most `workers` threads, each one with its
+            own session and connection
+        :return list: the responses of the selects, in the order of `queries`
+        """
+        queries = [self._select_args(*query) for query in queries]
+        if not queries:
+            return []
+        if workers:
+            pool = _thread_pool(min(workers, len(queries)))
+            try:
+                return pool.map(lambda args: self.select(*args), queries)
+            finally:
+                pool.terminate()
+        if getattr(self._local, 'session', None) is not None:
+            return [self._timed_select(*args) for args in queries]
+        with closing(self._new_session(read=True)) as session:
+            dialect = session.get_bind().dialect.name
+            if dialect in ('postgresql', 'mysql'):
+                session.connection(execution_options={
+                    'isolation_level': 'REPEATABLE READ'})
+            elif dialect == 'sqlite':
+                # ended by the rollback of the connection on close
+                session.connection().execute('BEGIN')
+            self._local.session = session
+            try:
+                return [self._timed_select(*args) for args in queries]
+            finally:
+                self._local.session = None
+
+    def _timed_select(self, modelName, queryDict, page, maxPerPage):
+        """Selects without cache within the timeout of the model, see
+        :meth:`_deadline`."""
+        with self._deadline(modelName, queryDict):
+            return self._select(modelName, queryDict, page, maxPerPage)
+
+    def _select_args(self, modelName, queryDict=None, page=1, maxPerPage=None):
+        if maxPerPage is None:
+            maxPerPage = self._maxResultsPerPage
+        return modelName, queryDict or {}, page, maxPerPage
+
+    def insert_many(self, modelName, rows, chunkSize=1000):
+        """
+        Inserts rows in the table corresponding to modelName, with
+        executemany statements of at most chunkSize rows, committing after
+        each one.
+
+        :param modelName str: the name of the model within the Manager
+        :param rows: an iterable of dictionaries mapping column attributes
+            of the model to values, date strings and intervals are converted
+            as by :func:`alchemyjson.utils.helpers.strings_to_dates`
+        :param chunkSize int: the number of rows inserted per statement
+        :return int: the number of inserted rows
+        """
+        return self._write_chunks(modelName, rows, chunkSize, insert_rows)
+
+    def upsert_many(self, modelName, rows, key=None, chunkSize=1000):
+        """
+        Inserts rows in the table corresponding to modelName, or updates
+        the existing rows having the same key, in batches of at most
+        chunkSize rows, committing after each one. ``INSERT ... ON CONFLICT``
+        is used when supported by the database, see
+        :func:`alchemyjson.utils.bulk.upsert_rows`. :exc:`ValueError` is
+        raised, naming the index of the row, if a row has no value for one of
+        the key attributes, the batches of the previous rows being written.
+
+        :param modelName str: the name of the model within the Manager
+        :param rows: an iterable of dictionaries, see :meth:`insert_many`
+        :param key list: the names of the attributes identifying a row,
+            they must be covered by a unique constraint, defaults to the
+            primary key
+        :param chunkSize int: the number of rows upserted per batch
+        :return int: the number of processed rows
+        """
+        rows = check_keys(self.get_model(modelName), rows, key)
+        return self._write_chunks(modelName, rows, chunkSize,
+                                  lambda s, m, c: upsert_rows(s, m, c, key))
+
+    def update(self, modelName, queryDict, values, synchronizeSession=False):
+        """
+        Sets values on all the rows of the table corresponding to modelName
+        matching queryDict with a single UPDATE statement, without loading
+        them.
+
+        :param modelName str: the name of the model within the Manager
+        :param queryDict dict: the ``filters`` and ``disjunction``
+            specifications of the updated rows, see :meth:`select`
+        :param values dict: a dictionary mapping column attributes to their
+            new values, date strings and intervals are converted as by
+            :func:`alchemyjson.utils.helpers.strings_to_dates`
+        :param synchronizeSession: how the instances already loaded in the
+            session are synchronized, either False (not synchronized, the
+            default since the session is not shared outside
+            :meth:`session_scope`), 'evaluate' (the filters are evaluated in
+            Python, which is not supported by the has and any operators) or
+            'fetch' (the matching primary keys are selected beforehand),
+            see :meth:`sqlalchemy.orm.query.Query.update`
+        :return int: the number of updated rows
+        """
+        model = self.get_model(modelName)
+        self._check_unsharded(modelName)
+        self._check_writable()
+        with self._session() as session:
+            q = self._write_query(session, model, queryDict)
+            num_results = q.update(strings_to_dates(model, values),
+                                   synchronize_session=synchronizeSession)
+            self._commit(session)
+        return num_results
+
+    def delete(self, modelName, queryDict, synchronizeSession=False):
+        """
+        Deletes all the rows of the table corresponding to modelName
+        matching queryDict with a single DELETE statement, without loading
+        them. Note that ORM level cascades are not applied.
+
+        :param modelName str: the name of the model within the Manager
+        :param queryDict dict: the ``filters`` and ``disjunction``
+            specifications of the deleted rows, see :meth:`select`
+        :param synchronizeSession: how the instances already loaded in the
+            session are synchronized, see :meth:`update`
+        :return int: the number of deleted rows
+        """
+        model = self.get_model(modelName)
+        self._check_unsharded(modelName)
+        self._check_writable()
+        with self._session() as session:
+            q = self._write_query(session, model, queryDict)
+            num_results = q.delete(synchronize_session=synchronizeSession)
+            self._commit(session)
+        return num_results
+
+    def _write_query(self, session, model, queryDict):
+        queryDict = queryDict or {}
+        if queryDict.get('limit') or queryDict.get('offset'):
+            raise ValueError('limit and offset are not supported by set based '
+                             'updates and deletes')
+        sp = SearchParameters.from_dictionary(queryDict)
+        filters = create_filters(model, sp)
+        return session.query(model).filter(sp.junction(*filters))
+
+    def _write_chunks(self, modelName, rows, chunkSize, write):
+        model = self.get_model(modelName)
+        self._check_unsharded(modelName)
+        self._check_writable()
+        written = 0
+        with self._session() as session:
+            for chunk in chunks(rows, chunkSize):
+                write(session, model, chunk)
+                self._mark_written(session, model)
+                self._commit(session)
+                written += len(chunk)
+        return written
+
+    def _commit(self, session):
+        """Commits `session`, or only flushes it within :meth:`session_scope`
+        which commits on exit."""
+        if getattr(self._local, 'scope', None) is not None:
+            session.flush()
+        else:
+            session.commit()
+
+    def _check_writable(self):
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None and scope.readOnly:
+            raise ReadOnlyError('writes are not allowed in a read only scope')
+
+    def _check_unsharded(self, modelName):
+        if modelName in self.shardedModels:
+            raise ValueError('{0} is sharded, only select and select_by_unique '
+                             'are supported'.format(modelName))
+
+    def _mark_written(self, session, model):
+        """Records that the table of `model` has been written through
+        statements which do not notify the session (as executemany)."""
+        if self.cache is not None:
+            self.cache.mark_written(session, model_tables(model))
+        if self.prefetcher is not None:
+            self.prefetcher.cache.mark_written(session, model_tables(model))
 
     def to_json(self, myDict):
         return self._encoder.encode(myDict)
 
-    def select(self, modelName, queryDict=None, page=1, maxPerPage=None):
+    def select(self, modelName, queryDict=None, page=1, maxPerPage=None,
+               timeout=None):
         """
         Issue a SELECT statement on the table corresponding to modelName.
         Results are paginaged and the page to be returned or the maximum
@@ -110,9 +805,31 @@ class Manager(object):
                 * ``joinedload`` specifies a list of relations to be loaded using the
                   SQLAlchemy joinedload strategy (by default lazy load is used which
                   is not very efficient when serializing relations)
+                * ``functions`` is a list of functions specifications of the form
+                  ``{"name": "count", "field": "id"}``, when given a dictionary
+                  ``{"count__id": 4, ...}`` is returned instead of the paginated rows
+                * ``group_by`` is a list of local or many to one relation fields
+                  (``"<relation>__<field>"``), when given the ``functions`` are evaluated
+                  per group and the groups are returned as paginated rows
+                * ``having`` is a list of conditions on the functions evaluated per group
+                  of the form ``{"name": "count", "field": "id", "op": "gt", "val": 2}``
+                * ``fields`` is a list of local or relation fields (``"<relation>__<field>"``),
+                  when given only the values of these fields are returned as paginated rows,
+                  without loading any SQLAlchemy object
+                * ``distinct`` specifies whether duplicated rows of ``fields`` are removed
+                * ``sample`` is of the form ``{"n": 1000, "seed": 42}``, when given
+                  ``n`` random rows matching the filters are returned as a single page,
+                  always the same ones for a given ``seed``, see :meth:`_select_sample`
         :param page int: the page number to be returned
         :param maxPerPage int: the maximum number of results per page, defaults
             to the maxResultsPerPage attribute,
+        :param timeout float: the number of seconds after which the statements
+            of the select are aborted by the database, defaults to the timeout
+            of the model (see :meth:`add_model`), if any. This is supported on
+            PostgreSQL (``statement_timeout``) and SQLite (a progress handler
+            interrupting the statement). :exc:`QueryTimeout` is then raised,
+            after the connection has been returned to the pool, and counted
+            in :meth:`timeout_stats`
         :return dict: a dictionary of the form::
 
                {
@@ -127,32 +844,641 @@ class Manager(object):
             As said, however, only maxPerPage results will be returned by each select.
         """
         if not queryDict: queryDict = {}
-        model = self.get_model(modelName)
+        if maxPerPage is None:
+            maxPerPage = self._maxResultsPerPage
+        if self._shapes is not None:
+            self._record_shape(modelName, queryDict, maxPerPage)
+        with self._deadline(modelName, queryDict, timeout):
+            sample = queryDict.get('sample')
+            if sample and sample.get('seed') is None:
+                # a random sample is not to be cached
+                return self._select(modelName, queryDict, page, maxPerPage)
+            prefetcher = self.prefetcher
+            if prefetcher is None or \
+                    getattr(self._local, 'scope', None) is not None:
+                return self._cached_select(modelName, queryDict, page,
+                                           maxPerPage)
+            rsp = prefetcher.take((modelName, canonical_query(queryDict), page,
+                                   maxPerPage))
+            if rsp is None:
+                rsp = self._cached_select(modelName, queryDict, page,
+                                          maxPerPage)
+            if isinstance(rsp, dict) and 'objects' in rsp \
+                    and page < rsp.get('total_pages', 0):
+                self._prefetch(prefetcher, modelName, deepcopy(queryDict),
+                               page + 1, maxPerPage, timeout)
+            return rsp
+
+    def _prefetch(self, prefetcher, modelName, queryDict, page, maxPerPage,
+                  timeout=None):
+        key = (modelName, canonical_query(queryDict), page, maxPerPage)
+        tables = self._query_tables(modelName, queryDict)
+
+        def call():
+            with self._deadline(modelName, queryDict, timeout):
+                return self._select(modelName, queryDict, page, maxPerPage)
+        prefetcher.schedule(key, tables, call)
+
+    @contextmanager
+    def _deadline(self, modelName, queryDict, timeout=None):
+        """Aborts the statements executed by the current thread within the
+        context once `timeout` seconds, defaulting to the timeout of the
+        model, have elapsed, see :mod:`alchemyjson.utils.timeout`, and raises
+        :exc:`QueryTimeout` instead of the resulting database error.
+        """
+        if timeout is None:
+            timeout = self.modelTimeouts.get(modelName)
+        if not timeout:
+            yield
+            return
+        if not self._timeoutsEnforced:
+            for engine in self._engines():
+                enforce_timeouts(engine)
+            self._timeoutsEnforced = True
+        with deadline(timeout) as current:
+            try:
+                yield
+            except DBAPIError:
+                if not current.expired():
+                    raise
+                self._count_timeout(modelName, queryDict)
+                raise QueryTimeout('select of {0} timed out after {1} '
+                                   'seconds'.format(modelName,
+                                                    current.timeout))
+
+    def _count_timeout(self, modelName, queryDict):
+        shape = query_shape(queryDict)
+        with self._timeoutsLock:
+            shapes = self._timeouts.setdefault(modelName, {})
+            if shape not in shapes and len(shapes) >= self.MAX_TIMEOUT_SHAPES:
+                shape = 'other'
+            shapes[shape] = shapes.get(shape, 0) + 1
+
+    def timeout_stats(self):
+        """Returns a dictionary mapping the names of the models to the
+        number of their selects which timed out, in total and per query shape
+        (see :func:`alchemyjson.utils.cache.query_shape`)::
+
+            {"employees": {"total": 3, "shapes": {'{"filters":...}': 3}}}
+        """
+        with self._timeoutsLock:
+            return dict((name, dict(total=sum(shapes.values()),
+                                    shapes=dict(shapes)))
+                        for name, shapes in self._timeouts.items())
+
+    def _cached_select(self, modelName, queryDict, page, maxPerPage):
+        """Selects through the response cache and the coalescing, if
+        enabled."""
+        cache, coalescer = self.cache, self.coalescer
+        if (cache is None and coalescer is None) or \
+                getattr(self._local, 'scope', None) is not None:
+            return self._select(modelName, queryDict, page, maxPerPage)
+        key = (modelName, canonical_query(queryDict), page, maxPerPage)
+        if cache is not None:
+            rsp = cache.get(key)
+            if rsp is not None:
+                return rsp
+        if coalescer is None:
+            return self._select_and_store(key, modelName, queryDict, page,
+                                          maxPerPage)
+        return coalescer.do(key, lambda: self._select_and_store(
+            key, modelName, queryDict, page, maxPerPage))
+
+    def _select_and_store(self, key, modelName, queryDict, page, maxPerPage):
+        cache = self.cache
+        if cache is None:
+            return self._select(modelName, queryDict, page, maxPerPage)
+        token = cache.token()
+        rsp = self._select(modelName, queryDict, page, maxPerPage)
+        cache.put(key, rsp, self._query_tables(modelName, queryDict),
+                  token, ttl=self.modelCacheTtl.get(modelName))
+        return rsp
+
+    def _query_tables(self, modelName, queryDict):
+        """Returns the names of the tables on which the select depends, see
+        :func:`alchemyjson.utils.cache.query_tables`, the ``to_dict``
+        specification being merged with the default one of the model.
+        """
+        queryDict = dict(queryDict or {})
         modelDictKargs = deepcopy(self.modelDictKargs[modelName])
-        with closing(self.dbConnection.get_session()) as session:
+        modelDictKargs.update(queryDict.get('to_dict', {}))
+        queryDict['to_dict'] = modelDictKargs
+        return query_tables(self.get_model(modelName), queryDict)
+
+    def _select(self, modelName, queryDict, page, maxPerPage):
+        if modelName in self.shardedModels:
+            return self._select_sharded(modelName, queryDict, page, maxPerPage)
+        model = self.get_model(modelName)
+        with self._session(read=True) as session:
             sp = SearchParameters.from_dictionary(queryDict)
-            q = create_query(session, model, sp)
+            if queryDict.get('sample'):
+                return self._select_sample(session, modelName, queryDict, sp)
+            if queryDict.get('fields'):
+                return self._select_fields(session, model, sp,
+                                           queryDict['fields'],
+                                           queryDict.get('distinct'), page,
+                                           maxPerPage)
+            if queryDict.get('group_by'):
+                return self._evaluate_grouped_functions(
+                    session, model, queryDict.get('functions'), sp,
+                    queryDict['group_by'], queryDict.get('having'), page,
+                    maxPerPage)
+            q, plan = self._rows_query(session, modelName, queryDict, sp)
             is_single = queryDict.get('single')
             functions = queryDict.get('functions')
-            todict = queryDict.get('to_dict', {})
-            modelDictKargs.update(todict)
-            jload = queryDict.pop('joinedload', None)
-            if jload:
-                q = q.options(*(joinedload(x) for x in jload))
             if is_single:
-                return to_dict(q.one(), **modelDictKargs)
+                return plan.to_dict(plan.apply(q).one())
             elif functions:
                 return self._evaluate_functions(session, model, functions,
                                                 sp)
             else:
-                if maxPerPage is None:
-                    maxPerPage = self._maxResultsPerPage
                 return self._paginated(q, page_num=page,
                                        results_per_page=maxPerPage,
-                                       model_dict_kargs=modelDictKargs)
+                                       plan=plan)
+
+    def _rows_query(self, session, modelName, queryDict, search_params):
+        """Returns the query of the instances of the model selected by
+        `queryDict` and the :class:`SerializerPlan` with which to serialize
+        them, whose hybrid columns are not added to the query yet.
+        """
+        model = self.get_model(modelName)
+        q = create_query(session, model, search_params)
+        jload = queryDict.get('joinedload')
+        if jload:
+            q = q.options(*(joinedload(x) for x in jload))
+        modelDictKargs = deepcopy(self.modelDictKargs[modelName])
+        modelDictKargs.update(queryDict.get('to_dict', {}))
+        return q, SerializerPlan(model, modelDictKargs)
+
+    def _select_sharded(self, modelName, queryDict, page, maxPerPage):
+        """Selects a sharded model: the shards which may hold matching rows
+        are queried concurrently, each one in its own session, and their
+        results are gathered:
+
+        * the rows (or ``fields`` rows) of every shard, ordered by the
+          ``order_by`` specifications, are merged by a k-way merge, only the
+          rows up to the requested page being fetched from each shard, and
+          ``num_results`` is the sum of the per shard numbers of results,
+        * the ``functions`` are combined: counts and sums are summed, the
+          minimum and maximum taken and the averages weighted by the per shard
+          counts,
+        * the ``group_by`` groups are combined likewise before ``having``,
+          ordering and pagination are applied.
+        """
+        model = self.get_model(modelName)
+        if queryDict.get('sample'):
+            raise ValueError('sampling a sharded model is not supported')
+        sharded = self.shardedModels[modelName]
+        sp = SearchParameters.from_dictionary(queryDict)
+        shardNames = sharded.shard_names(sp)
+        if queryDict.get('fields'):
+            return self._gather_fields(sharded, shardNames, model, sp,
+                                       queryDict['fields'],
+                                       queryDict.get('distinct'), page,
+                                       maxPerPage)
+        if queryDict.get('group_by'):
+            return self._gather_groups(sharded, shardNames, model, sp,
+                                       queryDict.get('functions') or [],
+                                       queryDict['group_by'],
+                                       queryDict.get('having') or [], page,
+                                       maxPerPage)
+        if queryDict.get('single'):
+            def fetch(session):
+                q, plan = self._rows_query(session, modelName, queryDict, sp)
+                return [plan.to_dict(x) for x in plan.apply(q).limit(2)]
+            found = [x for rows in self._scatter(sharded, shardNames, fetch)
+                     for x in rows]
+            if not found:
+                raise NoResultFound('No row was found for one()')
+            if len(found) > 1:
+                raise MultipleResultsFound('Multiple rows were found for one()')
+            return found[0]
+        if queryDict.get('functions'):
+            functions = queryDict['functions']
+            shardFunctions = shard_functions(functions)
+            results = self._scatter(
+                sharded, shardNames,
+                lambda session: self._evaluate_functions(session, model,
+                                                         shardFunctions, sp))
+            return combine_functions(functions, results)
+        offset = sp.offset or 0
+        needed = offset + page * maxPerPage if maxPerPage > 0 else None
+        if sp.limit:
+            needed = offset + (sp.limit if needed is None
+                               else min(sp.limit, needed - offset))
+        shardSp = copy(sp)
+        shardSp.limit = shardSp.offset = None
+        if sp.order_by:
+            keyFields = [o.field for o in sp.order_by]
+            directions = [o.direction for o in sp.order_by]
+        else:
+            keyFields = primary_key_names(model)
+            directions = ['asc'] * len(keyFields)
+
+        def fetch(session):
+            q, plan = self._rows_query(session, modelName, queryDict, shardSp)
+            total = q.count()
+            q = plan.apply(q)
+            if needed is not None:
+                q = q.limit(needed)
+            return total, [(SortKey(tuple(getattr(plan.instance(x), f)
+                                          for f in keyFields), directions),
+                            plan.to_dict(x)) for x in q]
+
+        results = self._scatter(sharded, shardNames, fetch)
+        num_results = max(sum(total for total, rows in results) - offset, 0)
+        if sp.limit:
+            num_results = min(num_results, sp.limit)
+        start, end, page, total_pages, num_results = \
+            get_pagination(None, page, maxPerPage, num_results)
+        merged = merge_sorted([rows for total, rows in results],
+                              key=lambda row: row[0])
+        objects = [row[1] for row in islice(merged, offset + start,
+                                            offset + end)]
+        return dict(page=page, objects=objects, total_pages=total_pages,
+                    num_results=num_results)
+
+    def _gather_fields(self, sharded, shardNames, model, search_params,
+                       fields, distinct, page, maxPerPage):
+        """Gathers the ``fields`` rows of the shards, see
+        :meth:`_select_sharded`, the rows of all the shards being fetched
+        when duplicates are to be removed. The ``limit`` and ``offset`` apply
+        to the gathered rows."""
+        if search_params.order_by:
+            indices = [fields.index(o.field) for o in search_params.order_by]
+            directions = [o.direction for o in search_params.order_by]
+        else:
+            indices = list(range(len(fields)))
+            directions = ['asc'] * len(fields)
+        offset = search_params.offset or 0
+        limit = search_params.limit
+        needed = None
+        if not distinct:
+            if maxPerPage > 0:
+                needed = page * maxPerPage
+            if limit:
+                needed = min(needed or limit, limit)
+            if needed is not None:
+                needed += offset
+        shardSp = copy(search_params)
+        shardSp.limit = shardSp.offset = None
+
+        def fetch(session):
+            query = self._fields_query(session, model, shardSp, fields,
+                                       distinct)
+            total = None if distinct else query.count()
+            if needed is not None:
+                query = query.limit(needed)
+            return total, [tuple(to_value(v) for v in row) for row in query]
+
+        results = self._scatter(sharded, shardNames, fetch)
+        merged = merge_sorted(
+            [rows for total, rows in results],
+            key=lambda row: SortKey(tuple(row[i] for i in indices), directions))
+        if distinct:
+            seen = set()
+            rows = []
+            for row in merged:
+                if row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+            num_results = len(rows)
+        else:
+            rows = merged
+            num_results = sum(total for total, rows in results)
+        rows = islice(rows, offset, None)
+        num_results = max(0, num_results - offset)
+        if limit:
+            num_results = min(num_results, limit)
+        start, end, page, total_pages, num_results = \
+            get_pagination(None, page, maxPerPage, num_results)
+        objects = [dict(zip(fields, row)) for row in islice(rows, start, end)]
+        return dict(page=page, objects=objects, total_pages=total_pages,
+                    num_results=num_results)
+
+    def _gather_groups(self, sharded, shardNames, model, search_params,
+                       functions, group_by, having, page, maxPerPage):
+        """Gathers the ``group_by`` groups of the shards, see
+        :meth:`_select_sharded`: all the groups of every shard are fetched
+        and combined, then ``having`` is evaluated on the combined
+        function values."""
+        evaluated = functions + [dict(name=c['name'], field=c['field'])
+                                 for c in having]
+        shardFunctions = shard_functions(evaluated)
+        for condition in having:
+            self._having_operator(condition)
+        self._check_group_order(
+            search_params, group_by + ['{0}__{1}'.format(f['name'], f['field'])
+                                       for f in functions])
+        shardSp = copy(search_params)
+        shardSp.order_by = []
+        shardSp.limit = shardSp.offset = None
+        results = self._scatter(
+            sharded, shardNames,
+            lambda session: self._evaluate_grouped_functions(
+                session, model, shardFunctions, shardSp, group_by)['objects'])
+        groups = {}
+        for rows in results:
+            for row in rows:
+                groups.setdefault(tuple(row[f] for f in group_by),
+                                  []).append(row)
+        objects = []
+        for key, rows in groups.items():
+            values = combine_functions(evaluated, rows)
+            if not all(self._having(values, c) for c in having):
+                continue
+            obj = dict(zip(group_by, key))
+            obj.update(combine_functions(functions, rows))
+            objects.append(obj)
+        if search_params.order_by:
+            keyFields = [o.field for o in search_params.order_by]
+            directions = [o.direction for o in search_params.order_by]
+        else:
+            keyFields = group_by
+            directions = ['asc'] * len(group_by)
+        objects.sort(key=lambda obj: SortKey(tuple(obj[f] for f in keyFields),
+                                             directions))
+        offset = search_params.offset or 0
+        objects = objects[offset:offset + search_params.limit
+                          if search_params.limit else None]
+        start, end, page, total_pages, num_results = \
+            get_pagination(None, page, maxPerPage, len(objects))
+        return dict(page=page, objects=objects[start:end],
+                    total_pages=total_pages, num_results=num_results)
+
+    def _check_group_order(self, search_params, names):
+        """Raises :exc:`ValueError` if the groups are ordered by a field
+        which is not one of the ``group_by`` fields and function `names`."""
+        for orderBy in search_params.order_by:
+            if orderBy.field not in names:
+                raise ValueError('cannot order groups by {0!r}, neither a '
+                                 'group_by field nor a function'.format(
+                                     orderBy.field))
+
+    def _having_operator(self, condition):
+        """Returns the operator function of the ``having`` `condition` and
+        whether it is unary, raises :exc:`ValueError` if the operator is
+        unknown or does not accept one or two arguments."""
+        opfunc = OPERATORS.get(condition.get('op'))
+        if opfunc is None:
+            raise ValueError('unknown having operator {0!r}'.format(
+                condition.get('op')))
+        arity = len(fn_inspect.getargspec(opfunc)[0])
+        if arity not in (1, 2):
+            raise ValueError('the {0!r} operator is not supported in having '
+                             'conditions'.format(condition['op']))
+        return opfunc, arity == 1
+
+    def _having(self, values, condition):
+        """Evaluates the ``having`` `condition` on the combined function
+        `values`, a comparison with a ``None`` value being false."""
+        opfunc, unary = self._having_operator(condition)
+        value = values['{0}__{1}'.format(condition['name'],
+                                         condition['field'])]
+        if unary:
+            return opfunc(value)
+        return value is not None and opfunc(value, condition.get('val'))
+
+    def _scatter(self, sharded, shardNames, call):
+        """Returns the list of the results of `call(session)` executed on
+        every shard of `shardNames` in a new session, concurrently, subject
+        to the deadline of the current thread if any."""
+        current = current_deadline()
+
+        def run(shardName):
+            connection = sharded.connections[shardName]
+            getSession = getattr(connection, 'get_read_session',
+                                 connection.get_session)
+            with use_deadline(current), closing(getSession()) as session:
+                return call(session)
+
+        if len(shardNames) <= 1:
+            return [run(shardName) for shardName in shardNames]
+        pool = _thread_pool(len(shardNames))
+        try:
+            return pool.map(run, shardNames)
+        finally:
+            pool.terminate()
+
+    def _select_sample(self, session, modelName, queryDict, search_params):
+        """Selects a random sample of the rows matching the filters of
+        `queryDict`, whose ``sample`` specification is of the form
+        ``{"n": 1000, "seed": 42, "method": None}``, see
+        :func:`alchemyjson.utils.sampling.sample_keys`. The sampled rows are
+        returned as a single page, ordered by primary key.
+        """
+        model = self.get_model(modelName)
+        spec = queryDict['sample']
+        filters = create_filters(model, search_params)
+        keys = sample_keys(session, model, search_params.junction(*filters),
+                           int(spec['n']), spec.get('seed'),
+                           spec.get('method'))
+        # the attribute names of the primary key columns, in the order of
+        # the sampled keys
+        mapper = inspect(model)
+        pks = [mapper.get_property_by_column(c).key for c in mapper.primary_key]
+        q, plan = self._rows_query(session, modelName, queryDict,
+                                   SearchParameters())
+        q = plan.apply(q)
+        found = {}
+        for chunk in chunks(sorted(keys), IN_BATCH_SIZE):
+            if len(pks) == 1:
+                condition = getattr(model, pks[0]).in_([k[0] for k in chunk])
+            else:
+                condition = or_(*(and_(*(getattr(model, name) == value
+                                         for name, value in zip(pks, key)))
+                                  for key in chunk))
+            for row in q.filter(condition):
+                instance = plan.instance(row)
+                found[tuple(getattr(instance, k) for k in pks)] = \
+                    plan.to_dict(row)
+        objects = [found[key] for key in sorted(found)]
+        return dict(page=1, objects=objects, total_pages=1,
+                    num_results=len(objects))
+
+    def iter_pages(self, modelName, queryDict=None, maxPerPage=None,
+                   workers=4, readAhead=None):
+        """
+        Iterates over all the pages of the select of modelName with
+        queryDict, see :meth:`select`, fetching them concurrently.
+
+        The number of results is counted once, then the pages are fetched
+        by a pool of worker threads, each one with its own session, and
+        yielded in order, at most `readAhead` pages being fetched in advance.
+        When the results are ordered by the (single column) primary key only
+        and no limit or offset is given, the pages are delimited by primary
+        key ranges computed beforehand rather than by offsets.
+
+        :param modelName str: the name of the model within the Manager
+        :param queryDict dict: the query, see :meth:`select`, only the
+            paginated rows mode is supported
+        :param maxPerPage int: the number of results per page, defaults to
+            the maxResultsPerPage attribute
+        :param workers int: the number of worker threads
+        :param readAhead int: the maximum number of pages fetched in advance,
+            defaults to twice the number of workers
+        :return: a generator of the pages, as returned by :meth:`select`
+        """
+        modelName, queryDict, page, maxPerPage = \
+            self._select_args(modelName, queryDict, 1, maxPerPage)
+        model = self.get_model(modelName)
+        self._check_unsharded(modelName)
+        sp = SearchParameters.from_dictionary(queryDict)
+        with self._session(read=True) as session:
+            q, plan = self._rows_query(session, modelName, queryDict, sp)
+            num_results = q.count()
+            bounds = self._keyset_bounds(session, model, sp, maxPerPage)
+        total_pages = get_pagination(q, 1, maxPerPage, num_results)[3]
+        pk = getattr(model, primary_key_names(model)[0])
+
+        def fetch(page):
+            with self._session(read=True) as session:
+                q = self._rows_query(session, modelName, queryDict, sp)[0]
+                if not bounds:
+                    return paginated(q, page, maxPerPage,
+                                     num_results=num_results, plan=plan)
+                q = plan.apply(q.filter(pk >= bounds[page - 1]))
+                if page < len(bounds):
+                    q = q.filter(pk < bounds[page])
+                return dict(page=page,
+                            objects=[plan.to_dict(x) for x in q],
+                            total_pages=total_pages, num_results=num_results)
+
+        if readAhead is None:
+            readAhead = 2 * workers
+        pool = _thread_pool(workers)
+        try:
+            pending = {}
+            nextPage = 1
+            for page in range(1, total_pages + 1):
+                while nextPage <= min(total_pages, page + readAhead):
+                    pending[nextPage] = pool.apply_async(fetch, (nextPage,))
+                    nextPage += 1
+                yield pending.pop(page).get()
+        finally:
+            pool.terminate()
+
+    def stream(self, modelName, queryDict=None, batchSize=1000):
+        """
+        Iterates over the serialized results of the select of modelName
+        with queryDict, see :meth:`select`, in constant memory.
+
+        The rows are fetched in batches of `batchSize` through a server side
+        cursor where the database driver supports it, and every instance is
+        serialized and released before the next one is loaded. The session
+        is kept open only while iterating and is closed when the generator
+        is exhausted or closed.
+
+        :param modelName str: the name of the model within the Manager
+        :param queryDict dict: the query, see :meth:`select`, only the
+            paginated rows mode is supported and ``joinedload`` is ignored,
+            since eager loading is not compatible with batched loading
+        :param batchSize int: the number of rows fetched per batch
+        :return: a generator of dictionaries, as the objects returned by
+            :meth:`select`
+        """
+        self._check_unsharded(modelName)
+        queryDict = dict(queryDict or {}, joinedload=None)
+        sp = SearchParameters.from_dictionary(queryDict)
+        with self._session(read=True) as session:
+            q, plan = self._rows_query(session, modelName, queryDict, sp)
+            q = plan.apply(q).yield_per(batchSize).execution_options(
+                stream_results=True)
+            for row in q:
+                yield plan.to_dict(row)
+
+    def export(self, modelName, queryDict, path, format='ndjson', compress=None,
+               fields=None, batchSize=1000):
+        """
+        Writes the serialized results of the select of modelName with
+        queryDict, see :meth:`select`, to the file `path`, streaming them
+        through :meth:`stream` so that memory does not depend on the number
+        of rows.
+
+        :param modelName str: the name of the model within the Manager
+        :param queryDict dict: the query, see :meth:`stream`
+        :param path str: the path of the written file
+        :param format str: either 'ndjson' or 'csv'
+        :param compress bool: whether the file is gzip compressed, by default
+            it is when `path` ends with '.gz'
+        :param fields list: the CSV columns, defaults to the sorted keys of
+            the first row
+        :param batchSize int: the number of rows fetched per batch
+        :return dict: the number of rows and bytes written, the elapsed
+            seconds and the throughput, see
+            :func:`alchemyjson.utils.export.export_rows`
+        """
+        from alchemyjson.utils.export import export_rows
+        return export_rows(self.stream(modelName, queryDict, batchSize), path,
+                           format=format, compress=compress, fields=fields,
+                           encoder=self.to_json)
+
+    def _keyset_bounds(self, session, model, search_params, maxPerPage):
+        """Returns the values of the primary key of the first result of
+        every page, or None if the pages cannot be delimited by primary key
+        ranges.
+        """
+        pks = primary_key_names(model)
+        if maxPerPage <= 0 or len(pks) != 1 or search_params.order_by \
+                or search_params.limit or search_params.offset:
+            return None
+        pk = getattr(model, pks[0])
+        filters = create_filters(model, search_params)
+        q = session.query(pk).filter(search_params.junction(*filters))
+        q = q.order_by(pk).yield_per(max(maxPerPage, 1000))
+        return [row[0] for i, row in enumerate(q) if i % maxPerPage == 0]
+
+    def _select_fields(self, session, model, search_params, fields,
+                       distinct=False, page=1, maxPerPage=0):
+        """Selects only the columns named in ``fields``, without loading
+        any model instance.
+        ``fields`` is a list of field names of `model`, or of the form
+        ``'<relation>__<field>'`` for a column of a related model, whose rows
+        are outer joined. If `distinct` is ``True`` duplicated rows are
+        removed by the database.
+        The rows are ordered by the ``order_by`` specifications of
+        `search_params`, which must refer to the ``fields``, or else by the
+        ``fields`` themselves, and the ``limit`` and ``offset`` of
+        `search_params` apply to the (distinct) rows.
+        Returns a paginated dictionary of the same form of :meth:`select`,
+        where each object maps the ``fields`` to their values.
+        """
+        query = self._fields_query(session, model, search_params, fields,
+                                   distinct)
+        start, end, page, total_pages, num_results = \
+            get_pagination(query, page, maxPerPage)
+        objects = [dict(zip(fields, (to_value(v) for v in row)))
+                   for row in query[start:end]]
+        return dict(page=page, objects=objects, total_pages=total_pages,
+                    num_results=num_results)
+
+    def _fields_query(self, session, model, search_params, fields,
+                      distinct=False):
+        """Returns the ordered query of the ``fields`` columns, see
+        :meth:`_select_fields`."""
+        joins = []
+        columns = dict((f, self._relation_column(model, f, joins))
+                       for f in fields)
+        query = session.query(*(columns[f] for f in fields))
+        for relation in joins:
+            query = query.outerjoin(getattr(model, relation))
+        filters = create_filters(model, search_params)
+        query = query.filter(search_params.junction(*filters))
+        if distinct:
+            query = query.distinct()
+        if search_params.order_by:
+            query = query.order_by(*(getattr(columns[o.field], o.direction)()
+                                     for o in search_params.order_by))
+        else:
+            query = query.order_by(*(columns[f] for f in fields))
+        if search_params.limit:
+            query = query.limit(search_params.limit)
+        if search_params.offset:
+            query = query.offset(search_params.offset)
+        return query
 
     def _paginated(self, query, page_num, results_per_page, model_dict_kargs=None,
-                   relload=None):
+                   relload=None, plan=None):
         """Returns a paginated JSONified response from the specified list of
         model instances.
         `instances` is either a Python list of model instances or a
@@ -167,7 +1493,7 @@ class Manager(object):
            }
         """
         return paginated(query, page_num, results_per_page, model_dict_kargs,
-                         relload)
+                         relload, plan=plan)
 
     def _create_query(self, session, model, search_params):
         """Builds an SQLAlchemy query instance based on the search parameters
@@ -325,28 +1651,51 @@ class Manager(object):
         processed = []
         funcnames = []
         for function in functions:
-            funcname, fieldname = function['name'], function['field']
-            # We retrieve the function by name from the SQLAlchemy ``func``
-            # module and the field by name from the model class.
-            #
-            # If the specified field doesn't exist, this raises AttributeError.
-            funcobj = getattr(func, funcname)
-            try:
-                field = getattr(model, fieldname)
-            except AttributeError as exception:
-                exception.field = fieldname
-                raise exception
+            funcname, funcobj = self._function_column(model, function)
             # Time to store things to be executed. The processed list stores
             # functions that will be executed in the database and funcnames
             # contains names of the entries that will be returned to the
             # caller.
-            funcnames.append('{0}__{1}'.format(funcname, fieldname))
-            processed.append(funcobj(field))
+            funcnames.append(funcname)
+            processed.append(funcobj)
         # Evaluate all the functions at once and get an iterable of results.
+        filters = self._create_filters(model, search_params)
+        query = session.query(*processed)
+        evaluated = self._run_functions(
+            query.filter(search_params.junction(*filters)).one)
+        return dict(zip(funcnames, evaluated))
+
+    def _function_column(self, model, function, condition=None):
+        """Returns the pair ``('<funcname>__<fieldname>', expression)`` for
+        the function specification `function` of the form
+        ``{'name': 'avg', 'field': 'amount'}``.
+        If `condition` is given, the function is only applied to the rows
+        matching it, by means of a ``CASE`` expression.
+        If the field does not exist on `model`, :exc:`AttributeError` is
+        raised with a ``field`` attribute set to the name of the field.
+        """
+        funcname, fieldname = function['name'], function['field']
+        # We retrieve the function by name from the SQLAlchemy ``func``
+        # module and the field by name from the model class.
+        #
+        # If the specified field doesn't exist, this raises AttributeError.
+        funcobj = getattr(func, funcname)
         try:
-            filters = self._create_filters(model, search_params)
-            query = session.query(*processed)
-            evaluated = query.filter(search_params.junction(*filters)).one()
+            field = getattr(model, fieldname)
+        except AttributeError as exception:
+            exception.field = fieldname
+            raise exception
+        if condition is not None:
+            field = case([(condition, field)])
+        return '{0}__{1}'.format(funcname, fieldname), funcobj(field)
+
+    def _run_functions(self, execute):
+        """Calls `execute`, setting the ``function`` attribute of the
+        :exc:`sqlalchemy.exc.OperationalError` raised by the database when
+        a function does not exist.
+        """
+        try:
+            return execute()
         except OperationalError as exception:
             # HACK original error message is of the form:
             #
@@ -355,6 +1704,91 @@ class Manager(object):
             bad_function = original_error_msg[37:]
             exception.function = bad_function
             raise exception
-        return dict(zip(funcnames, evaluated))
+
+    def _relation_column(self, model, fieldname, joins, scalarOnly=False):
+        """Returns the column named `fieldname` of `model`, or of the related
+        model if `fieldname` is of the form ``'<relation>__<field>'``, in
+        which case the relation is appended to `joins`.
+        If `scalarOnly` is ``True``, raises :exc:`ValueError` if the relation
+        is list-like.
+        """
+        if '__' not in fieldname:
+            return getattr(model, fieldname)
+        relation, fieldname = fieldname.split('__')
+        info = model_info(model).relations.get(relation)
+        if info is None:
+            raise ValueError('{0} is not a relation'.format(relation))
+        if scalarOnly and info.uselist:
+            raise ValueError('{0} is not a many to one relation'.format(relation))
+        if relation not in joins:
+            joins.append(relation)
+        return getattr(info.model, fieldname)
+
+    def _evaluate_grouped_functions(self, session, model, functions,
+                                    search_params, group_by, having=None,
+                                    page=1, maxPerPage=0):
+        """Evaluates the functions specified in ``functions`` (see
+        :meth:`_evaluate_functions`) for each group of rows sharing the same
+        values of the ``group_by`` fields, in a single statement.
+        ``group_by`` is a list of field names of `model`, or of the form
+        ``'<relation>__<field>'`` for a column of a many to one relation.
+        ``having`` is a list of conditions on the function results of the
+        form::
+            {'name': 'count', 'field': 'id', 'op': 'gt', 'val': 2}
+        where ``op`` is one of :data:`OPERATORS` accepting one or two
+        arguments, :exc:`ValueError` being raised for the other ones.
+        The rows whose many to one relation is ``None`` form the group of the
+        ``None`` value of the relation fields.
+        The groups are ordered by the ``order_by`` specifications of
+        `search_params`, where ``field`` is either a ``group_by`` field or
+        ``'<funcname>__<fieldname>'``, or else by the ``group_by`` fields, and
+        the ``limit`` and ``offset`` of `search_params` apply to the groups.
+        Returns a paginated dictionary of the same form of :meth:`select`,
+        where each object maps the ``group_by`` fields and the
+        ``'<funcname>__<fieldname>'`` names to their values for the group.
+        """
+        joins = []
+        names = []
+        columns = {}
+        for fieldname in group_by:
+            names.append(fieldname)
+            columns[fieldname] = self._relation_column(model, fieldname, joins,
+                                                       scalarOnly=True)
+        groupColumns = [columns[n] for n in names]
+        for function in functions or []:
+            funcname, funcobj = self._function_column(model, function)
+            names.append(funcname)
+            columns[funcname] = funcobj
+        conditions = []
+        for condition in having or []:
+            opfunc, unary = self._having_operator(condition)
+            funcobj = self._function_column(model, condition)[1]
+            if unary:
+                conditions.append(opfunc(funcobj))
+            else:
+                conditions.append(opfunc(funcobj, condition.get('val')))
+        query = session.query(*(columns[n] for n in names))
+        for relation in joins:
+            query = query.outerjoin(getattr(model, relation))
+        filters = create_filters(model, search_params)
+        query = query.filter(search_params.junction(*filters))
+        query = query.group_by(*groupColumns)
+        if conditions:
+            query = query.having(and_(*conditions))
+        self._check_group_order(search_params, names)
+        if search_params.order_by:
+            query = query.order_by(*(getattr(columns[o.field], o.direction)()
+                                     for o in search_params.order_by))
+        else:
+            query = query.order_by(*groupColumns)
+        if search_params.limit:
+            query = query.limit(search_params.limit)
+        if search_params.offset:
+            query = query.offset(search_params.offset)
+        start, end, page, total_pages, num_results = \
+            self._run_functions(lambda: get_pagination(query, page, maxPerPage))
+        objects = [dict(zip(names, row)) for row in query[start:end]]
+        return dict(page=page, objects=objects, total_pages=total_pages,
+                    num_results=num_results)
 
 
@@ -40,7 +40,7 @@ def populate_test_db():
 
 if __name__ == "__main__":
     c = populate_test_db()
-    print c.filename
+    print(c.filename)
 
 
 
@@ -1,7 +1,9 @@
+from sqlalchemy import func, select, true
 from sqlalchemy.ext.declarative.api import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import ForeignKey, Column
-from sqlalchemy.sql.sqltypes import Integer, String
+from sqlalchemy.sql.sqltypes import Integer, String, DateTime, Interval
 
 __author__ = 'chiesa'
 
@@ -27,3 +29,53 @@ class Employees(BASE):
     manager = relationship(Managers, backref='employees')
 
 
+class Meetings(BASE):
+
+    __tablename__ = 'meetings'
+
+    id = Column(Integer, primary_key=True)
+    start = Column(DateTime)
+    duration = Column(Interval)
+
+
+# the models mapping the tables of BASE once more, with hybrid properties
+HYBRID_BASE = declarative_base()
+
+
+class Teams(HYBRID_BASE):
+    """The managers table with hybrid properties, with and without a SQL
+    expression."""
+
+    __table__ = Managers.__table__
+
+    members = relationship(Employees, viewonly=True)
+
+    @hybrid_property
+    def size(self):
+        return len(self.members)
+
+    @size.expression
+    def size(cls):
+        return select([func.count(Employees.id)]).\
+            where(Employees.manager_id == cls.id)
+
+    @hybrid_property
+    def initial(self):
+        return self.name[:1]
+
+
+class SlowTeams(HYBRID_BASE):
+    """The managers table with a hybrid property whose expression is a slow
+    cross join."""
+
+    __table__ = Managers.__table__
+
+    @hybrid_property
+    def triples(self):
+        return None
+
+    @triples.expression
+    def triples(cls):
+        a, b, c = [Employees.__table__.alias() for i in range(3)]
+        return select([func.count()]).\
+            select_from(a.join(b, true()).join(c, true()))
@@ -0,0 +1,86 @@
+from alchemyjson.manager import Manager
+try:
+    import asyncio
+    from alchemyjson.asyncmanager import AsyncManager, _Call
+except ImportError:
+    asyncio = None
+
+__author__ = 'chiesa'
+
+from alchemyjson.tests.initializer import populate_test_db
+from alchemyjson.tests.mapping import Employees, Managers
+
+# -*- coding: utf-8 -*-
+"""
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+import threading
+import unittest
+
+#: A query running until interrupted
+ENDLESS_QUERY = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                 'SELECT count(*) FROM c')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TestAsyncManager(unittest.TestCase):
+
+    def setUp(self):
+        self.DB = populate_test_db()
+        self.manager = Manager(self.DB)
+        self.manager.add_model(Employees)
+        self.manager.add_model(Managers)
+        self.loop = asyncio.new_event_loop()
+        self.amanager = AsyncManager(self.manager, maxWorkers=2, loop=self.loop)
+
+    def tearDown(self):
+        self.amanager.close()
+        self.loop.close()
+
+    def test_select(self):
+        rsp = self.loop.run_until_complete(self.amanager.select('managers'))
+        self.assertEqual(rsp, self.manager.select('managers'))
+        rsp = self.loop.run_until_complete(
+            self.amanager.select('employees', {'functions': [{'name': 'count',
+                                                              'field': 'id'}]}))
+        self.assertEqual(rsp, {'count__id': 4})
+        rsp = self.loop.run_until_complete(self.amanager.select_by_unique('employees', 2))
+        self.assertEqual(rsp['name'], 'jack')
+
+    def test_running_loop(self):
+        # without loop, the calls are scheduled on the running loop
+        amanager = AsyncManager(self.manager, maxWorkers=1)
+        futures = []
+        self.loop.call_soon(lambda: futures.append(amanager.select('managers')))
+        try:
+            self.loop.run_until_complete(asyncio.sleep(0))
+            rsp = self.loop.run_until_complete(futures[0])
+        finally:
+            amanager.close()
+        self.assertEqual(rsp, self.manager.select('managers'))
+
+    def test_cancel_finished(self):
+        call = _Call()
+        self.amanager._execute(call, self.manager.select, ('managers',))
+        self.assertTrue(call.finished)
+        self.assertIsNone(call.dbapiConnection)
+        call.cancel()
+        self.assertFalse(call.cancelled)
+
+    def test_cancel(self):
+        def endless():
+            with self.manager._session() as session:
+                return session.execute(ENDLESS_QUERY).scalar()
+        future = self.amanager.call(endless)
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        future.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        closer = threading.Thread(target=self.amanager.close)
+        closer.start()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
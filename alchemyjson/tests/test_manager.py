@@ -1,9 +1,26 @@
-from alchemyjson.manager import Manager
+from contextlib import closing
+import datetime
+import gzip
+import json
+from sqlalchemy import event
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from tempfile import mkdtemp
+from alchemyjson.manager import Manager, QueryTimeout, ReadOnlyError
+from alchemyjson.utils.connection import LagAwarePolicy, RoutingConnection
+from alchemyjson.utils.search import SearchParameters
+from alchemyjson.utils import registry
+import alchemyjson
 
 __author__ = 'chiesa'
 
 from alchemyjson.tests.initializer import populate_test_db
-from alchemyjson.tests.mapping import Employees, Managers
+from alchemyjson.tests.mapping import (Employees, Managers, Meetings,
+                                       SlowTeams, Teams)
 
 # -*- coding: utf-8 -*-
 """
@@ -98,3 +115,800 @@ class TestMain(unittest.TestCase):
                                                                                        'op': 'eq',
                                                                                        'val': 'j'}]}]}]})
         self.assertEqual(rsp['num_results'], 1)
+
+
+def add_meetings(db, number):
+    with closing(db.get_session()) as session:
+        session.add_all(Meetings(start=datetime.datetime(2020, 1, 2, 3, i),
+                                 duration=datetime.timedelta(minutes=90 + i))
+                        for i in range(number))
+        session.commit()
+
+
+def value_types(rsp):
+    """Returns the types of the keys and values of the objects of `rsp`."""
+    return [sorted((type(k).__name__, k, type(v).__name__) for k, v in o.items())
+            for o in rsp['objects']]
+
+
+class TestSelectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.DB = populate_test_db()
+        self.manager = Manager(self.DB)
+        self.manager.add_model(Employees)
+        self.manager.add_model(Managers)
+        self.cache = self.manager.enable_cache(maxEntries=2, compress=True)
+
+    def tearDown(self):
+        self.manager.disable_cache()
+
+    def test_hit_and_invalidation(self):
+        queryDict = {'to_dict': {'deep': {'employees': []}}}
+        rsp1 = self.manager.select('managers', queryDict)
+        rsp2 = self.manager.select('managers', {'to_dict': {'deep': {'employees': []}}})
+        self.assertEqual(rsp1, rsp2)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        with closing(self.DB.get_session()) as session:
+            session.query(Employees).filter(Employees.name == 'jack').one().surname = 'k'
+            session.commit()
+        rsp3 = self.manager.select('managers', queryDict)
+        self.assertIn('k', [e['surname'] for e in rsp3['objects'][0]['employees']])
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_model_deep_invalidation(self):
+        self.manager.add_model(Managers, name='teams',
+                               toDictKargs={'deep': {'employees': []}})
+        rsp = self.manager.select('teams')
+        self.assertIn('jack', [e['name'] for e in rsp['objects'][0]['employees']])
+        with closing(self.DB.get_session()) as session:
+            session.query(Employees).filter(Employees.name == 'jack').one().name = 'jacky'
+            session.commit()
+        rsp = self.manager.select('teams')
+        self.assertIn('jacky', [e['name'] for e in rsp['objects'][0]['employees']])
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_hit_equals_miss(self):
+        self.manager.add_model(Meetings)
+        add_meetings(self.DB, 1)
+        miss = self.manager.select('meetings')
+        hit = self.manager.select('meetings')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(hit, miss)
+        self.assertEqual(value_types(hit), value_types(miss))
+        self.assertIsInstance(hit['objects'][0]['duration'], datetime.timedelta)
+
+    def test_eviction_and_ttl(self):
+        self.manager.select('employees', page=1, maxPerPage=1)
+        self.manager.select('employees', page=2, maxPerPage=1)
+        self.manager.select('employees', page=3, maxPerPage=1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.manager.modelCacheTtl['managers'] = -1
+        self.manager.select('managers')
+        self.manager.select('managers')
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+
+class TestGroupBy(unittest.TestCase):
+
+    DB = None
+    manager = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.DB = populate_test_db()
+        cls.manager = Manager(cls.DB)
+        cls.manager.add_model(Employees)
+        cls.manager.add_model(Managers)
+
+    def test_group_by(self):
+        rsp = self.manager.select('employees', {'functions': [{'name': 'count',
+                                                               'field': 'id'}],
+                                                'group_by': ['surname'],
+                                                'order_by': [{'field': 'count__id',
+                                                              'direction': 'desc'}]})
+        self.assertEqual(rsp['num_results'], 3)
+        self.assertEqual(rsp['objects'][0], {'surname': 'j', 'count__id': 2})
+        rsp = self.manager.select('employees', {'functions': [{'name': 'count',
+                                                               'field': 'id'}],
+                                                'group_by': ['surname'],
+                                                'having': [{'name': 'count',
+                                                            'field': 'id',
+                                                            'op': 'lt',
+                                                            'val': 2}]},
+                                  page=2, maxPerPage=1)
+        self.assertEqual(rsp['total_pages'], 2)
+        self.assertEqual(rsp['objects'], [{'surname': 'michael', 'count__id': 1}])
+
+    def test_group_by_relation(self):
+        rsp = self.manager.select('employees', {'functions': [{'name': 'count',
+                                                               'field': 'id'}],
+                                                'group_by': ['manager__name']})
+        self.assertEqual(rsp['objects'], [{'manager__name': 'johnny', 'count__id': 4}])
+        self.assertRaises(ValueError, self.manager.select, 'managers',
+                          {'functions': [{'name': 'count', 'field': 'id'}],
+                           'group_by': ['employees__name']})
+
+    def test_group_by_limit_and_having(self):
+        functions = [{'name': 'count', 'field': 'id'}]
+        rsp = self.manager.select('employees', {'functions': functions,
+                                                'group_by': ['surname'],
+                                                'limit': 1, 'offset': 1})
+        self.assertEqual((rsp['num_results'], rsp['objects']),
+                         (1, [{'surname': 'j', 'count__id': 2}]))
+        for op in ('has', 'bogus'):
+            self.assertRaises(ValueError, self.manager.select, 'employees',
+                              {'functions': functions, 'group_by': ['surname'],
+                               'having': [{'name': 'count', 'field': 'id', 'op': op,
+                                           'val': 1}]})
+        self.assertRaises(ValueError, self.manager.select, 'employees',
+                          {'functions': functions, 'group_by': ['surname'],
+                           'order_by': [{'field': 'name'}]})
+
+    def test_group_by_null_relation(self):
+        manager = Manager(populate_test_db())
+        manager.add_model(Employees)
+        manager.insert_many('employees', [{'name': 'solo'}])
+        rsp = manager.select('employees', {'functions': [{'name': 'count', 'field': 'id'}],
+                                           'group_by': ['manager__name'],
+                                           'order_by': [{'field': 'count__id'}]})
+        self.assertEqual(rsp['objects'], [{'manager__name': None, 'count__id': 1},
+                                          {'manager__name': 'johnny', 'count__id': 4}])
+
+    def test_evaluate_subsets(self):
+        rsp = self.manager.evaluate_subsets('employees',
+                                            {'j': {'filters': [{'name': 'surname',
+                                                                'op': 'eq',
+                                                                'val': 'j'}],
+                                                   'functions': [{'name': 'count',
+                                                                  'field': 'id'},
+                                                                 {'name': 'max',
+                                                                  'field': 'name'}]},
+                                             'all': {'functions': [{'name': 'count',
+                                                                    'field': 'id'}]},
+                                             'none': {}})
+        self.assertEqual(rsp, {'j': {'count__id': 2, 'max__name': 'jilly'},
+                               'all': {'count__id': 4},
+                               'none': {}})
+
+
+class TestFields(unittest.TestCase):
+
+    DB = None
+    manager = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.DB = populate_test_db()
+        cls.manager = Manager(cls.DB)
+        cls.manager.add_model(Employees)
+        cls.manager.add_model(Managers)
+
+    def test_distinct_fields(self):
+        rsp = self.manager.select('employees', {'fields': ['surname'],
+                                                'distinct': True,
+                                                'order_by': [{'field': 'surname',
+                                                              'direction': 'desc'}]},
+                                  maxPerPage=2)
+        self.assertEqual(rsp['num_results'], 3)
+        self.assertEqual(rsp['objects'], [{'surname': 'michael'}, {'surname': 'j'}])
+        rsp = self.manager.select('managers', {'fields': ['name', 'employees__surname'],
+                                               'distinct': True,
+                                               'filters': [{'name': 'name',
+                                                            'op': 'eq',
+                                                            'val': 'johnny'}]})
+        self.assertEqual([o['employees__surname'] for o in rsp['objects']],
+                         ['f', 'j', 'michael'])
+
+    def test_fields_limit_and_offset(self):
+        rsp = self.manager.select('employees', {'fields': ['name'], 'limit': 1})
+        self.assertEqual((rsp['num_results'], rsp['objects']),
+                         (1, [{'name': 'francy'}]))
+        rsp = self.manager.select('employees', {'fields': ['surname'],
+                                                'distinct': True,
+                                                'limit': 2, 'offset': 1},
+                                  page=2, maxPerPage=1)
+        self.assertEqual((rsp['num_results'], rsp['objects']),
+                         (2, [{'surname': 'michael'}]))
+
+
+class TestSelectPages(unittest.TestCase):
+
+    DB = None
+    manager = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.DB = populate_test_db()
+        cls.manager = Manager(cls.DB)
+        cls.manager.add_model(Employees)
+        cls.manager.add_model(Managers)
+
+    def test_select_many(self):
+        queries = [('managers',),
+                   ('employees', {'filters': [{'name': 'surname',
+                                               'op': 'eq',
+                                               'val': 'j'}]}),
+                   ('employees', None, 2, 1),
+                   ('employees', {'functions': [{'name': 'count',
+                                                 'field': 'id'}]})]
+        expected = [self.manager.select(*q) for q in queries]
+        self.assertEqual(self.manager.select_many(queries), expected)
+        self.assertEqual(self.manager.select_many(queries, workers=2), expected)
+
+    def test_select_many_snapshot(self):
+        db = populate_test_db()
+        manager = Manager(db)
+        manager.add_model(Employees)
+        with closing(sqlite3.connect(db.filename)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+        counts = []
+
+        def after_execute(conn, cursor, statement, *args):
+            # a commit of another connection between the two counts
+            if 'count' in statement and not counts:
+                counts.append(statement)
+                with closing(sqlite3.connect(db.filename, timeout=0)) as other:
+                    other.execute("INSERT INTO employees (name) VALUES ('new')")
+                    other.commit()
+        event.listen(db._engine, 'after_cursor_execute', after_execute)
+        try:
+            queries = [('employees', {'functions': [{'name': 'count', 'field': 'id'}]})] * 2
+            self.assertEqual(manager.select_many(queries), [{'count__id': 4}] * 2)
+            self.assertEqual(manager.select(*queries[0]), {'count__id': 5})
+        finally:
+            event.remove(db._engine, 'after_cursor_execute', after_execute)
+            db.close()
+
+    def test_iter_pages(self):
+        for queryDict in [None,
+                          {'order_by': [{'field': 'name', 'direction': 'desc'}]},
+                          {'filters': [{'name': 'surname', 'op': 'eq', 'val': 'j'}]}]:
+            expected = []
+            page = 1
+            while True:
+                rsp = self.manager.select('employees', queryDict, page, maxPerPage=1)
+                if not rsp['objects']:
+                    break
+                expected.append(rsp)
+                page += 1
+            pages = list(self.manager.iter_pages('employees', queryDict, maxPerPage=1,
+                                                 workers=2, readAhead=1))
+            self.assertEqual(pages, expected)
+
+    def test_stream(self):
+        queryDict = {'filters': [{'name': 'surname', 'op': 'ne', 'val': 'f'}],
+                     'to_dict': {'deep': {'manager': []}}}
+        rows = list(self.manager.stream('employees', queryDict, batchSize=2))
+        self.assertEqual(rows, self.manager.select('employees', queryDict,
+                                                   maxPerPage=0)['objects'])
+        stream = self.manager.stream('employees')
+        self.assertEqual(next(stream)['id'], 1)
+        stream.close()
+
+    def test_export(self):
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'employees.ndjson.gz')
+            stats = self.manager.export('employees', None, path)
+            self.assertEqual(stats['rows'], 4)
+            with closing(gzip.open(path)) as f:
+                rows = [json.loads(line.decode('utf-8')) for line in f]
+            self.assertEqual(rows, self.manager.select('employees')['objects'])
+            path = os.path.join(directory, 'employees.csv')
+            self.manager.export('employees', {'order_by': [{'field': 'name',
+                                                            'direction': 'asc'}]},
+                                path, format='csv', fields=['name', 'surname'])
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines()[:2], ['name,surname', 'francy,f'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.DB = populate_test_db()
+        self.manager = Manager(self.DB)
+        self.manager.add_model(Employees)
+        self.manager.add_model(Managers)
+
+    def test_insert_many(self):
+        self.manager.enable_cache()
+        self.assertEqual(self.manager.select('employees')['num_results'], 4)
+        rows = [{'name': 'e{0}'.format(i), 'surname': 's', 'manager_id': 1}
+                for i in range(25)]
+        rows.append({'name': 'alone'})
+        self.assertEqual(self.manager.insert_many('employees', rows, chunkSize=10), 26)
+        self.assertEqual(self.manager.select('employees')['num_results'], 30)
+        self.manager.disable_cache()
+
+    def test_native_dates(self):
+        self.manager.add_model(Meetings)
+        start = datetime.datetime(2020, 1, 2, 3, 4)
+        self.manager.insert_many('meetings', [{'id': 1, 'start': start},
+                                              {'id': 2, 'start': '2020-01-02T03:04:00'}])
+        self.manager.upsert_many('meetings', [{'id': 2, 'start': start,
+                                               'duration': datetime.timedelta(hours=1)}])
+        objects = self.manager.select('meetings')['objects']
+        self.assertEqual([o['start'] for o in objects], [start.isoformat()] * 2)
+        self.assertEqual(objects[1]['duration'], datetime.timedelta(hours=1))
+
+    def test_update_native_dates(self):
+        self.manager.add_model(Meetings)
+        add_meetings(self.DB, 2)
+        start = datetime.datetime(2021, 5, 6, 7, 8)
+        self.assertEqual(self.manager.update('meetings', None, {'start': start}), 2)
+        self.assertEqual([o['start'] for o in self.manager.select('meetings')['objects']],
+                         [start.isoformat()] * 2)
+
+    def test_upsert_many(self):
+        rows = [{'id': 1, 'name': 'mike', 'surname': 'm'},
+                {'id': 9, 'name': 'new', 'surname': 'n'},
+                {'id': 1, 'name': 'michael', 'surname': 'm'}]
+        self.assertEqual(self.manager.upsert_many('employees', rows), 3)
+        self.assertEqual(self.manager.select_by_unique('employees', 1),
+                         {'id': 1, 'name': 'michael', 'surname': 'm', 'manager_id': 1})
+        self.assertEqual(self.manager.select_by_unique('employees', 9)['name'], 'new')
+
+    def test_upsert_missing_key(self):
+        rows = [{'id': 2, 'name': 'jack', 'surname': 'j'},
+                {'name': 'nobody', 'surname': 'n'}]
+        with self.assertRaises(ValueError) as context:
+            self.manager.upsert_many('employees', rows)
+        self.assertEqual(str(context.exception),
+                         "row 1 has no value for the key column 'id'")
+        self.assertEqual(self.manager.select('employees')['num_results'], 4)
+        with self.assertRaises(ValueError):
+            self.manager.upsert_many('employees', rows[:1], key=['nickname'])
+
+    def test_update_and_delete(self):
+        self.manager.enable_cache()
+        self.assertEqual(self.manager.select('employees', {'fields': ['surname'],
+                                                           'distinct': True})['num_results'], 3)
+        self.assertEqual(self.manager.update('employees',
+                                             {'filters': [{'name': 'surname',
+                                                           'op': 'in',
+                                                           'val': ['j', 'f']}]},
+                                             {'surname': 'x'}), 3)
+        self.assertEqual(self.manager.select('employees', {'fields': ['surname'],
+                                                           'distinct': True})['num_results'], 2)
+        self.assertEqual(self.manager.delete('managers',
+                                             {'filters': [{'name': 'employees',
+                                                           'op': 'any',
+                                                           'val': {'name': 'surname',
+                                                                   'op': 'eq',
+                                                                   'val': 'x'}}]}), 1)
+        self.assertEqual(self.manager.select('managers')['num_results'], 0)
+        self.assertRaises(ValueError, self.manager.delete, 'employees', {'limit': 1})
+        self.manager.disable_cache()
+
+    def test_session_scope(self):
+        with self.manager.session_scope() as m:
+            m.update('employees', {'filters': [{'name': 'id', 'op': 'eq', 'val': 1}]},
+                     {'surname': 'x'})
+            m.insert_many('employees', [{'name': 'new'}])
+            self.assertEqual(m.select('employees', {'fields': ['surname'],
+                                                    'filters': [{'name': 'id',
+                                                                 'op': 'eq',
+                                                                 'val': 1}]})['objects'],
+                             [{'surname': 'x'}])
+            # not visible outside of the scope yet
+            self.assertEqual(self.manager.select_many([('employees',)], workers=1)[0]
+                             ['num_results'], 4)
+            m.rollback()
+            m.insert_many('employees', [{'name': 'kept'}])
+        self.assertEqual(self.manager.select('employees')['num_results'], 5)
+        self.assertEqual(self.manager.select_by_unique('employees', 1)['surname'], 'michael')
+        with self.manager.session_scope(readOnly=True) as m:
+            self.assertRaises(ReadOnlyError, m.delete, 'employees', {})
+            self.assertRaises(ReadOnlyError, m.session_scope().__enter__)
+        self.assertRaises(RuntimeError, self.manager.commit)
+
+
+class TestReadReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.DBs = [populate_test_db() for i in range(3)]
+        # the second replica lags behind by one employee
+        with closing(self.DBs[2].get_session()) as session:
+            session.query(Employees).filter(Employees.id == 4).delete()
+            session.commit()
+        self.connection = RoutingConnection(self.DBs[0]._engine,
+                                            [db._engine for db in self.DBs[1:]])
+        self.manager = Manager(self.connection)
+        self.manager.add_model(Employees)
+        self.manager.add_model(Managers)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_routing(self):
+        counts = [self.manager.select('employees')['num_results'] for i in range(4)]
+        self.assertEqual(counts, [4, 3, 4, 3])
+        self.manager.insert_many('employees', [{'name': 'new'}])
+        with closing(self.DBs[0].get_session()) as session:
+            self.assertEqual(session.query(Employees).count(), 5)
+        with self.connection.read_your_writes():
+            self.assertEqual(self.manager.select('employees')['num_results'], 5)
+            self.assertEqual(self.manager.select_by_unique('employees', 5)['name'], 'new')
+        with self.manager.session_scope() as m:
+            self.assertEqual(m.select('employees')['num_results'], 5)
+        self.assertEqual(self.manager.select('employees')['num_results'], 4)
+
+    def test_lag_aware(self):
+        lags = {self.DBs[1]._engine: 10., self.DBs[2]._engine: 1.}
+        connection = RoutingConnection(self.DBs[0]._engine,
+                                       [db._engine for db in self.DBs[1:]],
+                                       policy=LagAwarePolicy(lag=lags.get))
+        manager = Manager(connection)
+        manager.add_model(Employees)
+        self.assertEqual(manager.select('employees')['num_results'], 3)
+        lags[self.DBs[2]._engine] = 6.
+        connection.policy.refresh = 0
+        self.assertEqual(manager.select('employees')['num_results'], 4)
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.DBs = {'odd': populate_test_db(), 'even': populate_test_db()}
+        with closing(self.DBs['even'].get_session()) as session:
+            session.query(Employees).filter(Employees.id > 3).delete()
+            session.query(Employees).update({'manager_id': 2,
+                                             'id': Employees.id + 4})
+            session.commit()
+        self.manager = Manager(self.DBs['odd'])
+        self.manager.add_model(Employees, shards=self.DBs, shardBy='manager_id',
+                               shardKey=lambda v: 'odd' if v % 2 else 'even')
+        # the rows of both shards in a single database
+        self.single = Manager(populate_test_db())
+        self.single.add_model(Employees)
+        self.single.insert_many('employees',
+                                [{'id': i + 4, 'name': n, 'surname': s, 'manager_id': 2}
+                                 for i, n, s in [(1, 'michael', 'michael'),
+                                                 (2, 'jack', 'j'), (3, 'jilly', 'j')]])
+
+    def assertSameSelect(self, queryDict, page=1, maxPerPage=None):
+        self.assertEqual(self.manager.select('employees', queryDict, page, maxPerPage),
+                         self.single.select('employees', queryDict, page, maxPerPage))
+
+    def test_rows(self):
+        self.assertEqual(self.manager.select('employees')['num_results'], 7)
+        for page in (1, 2, 3):
+            self.assertSameSelect({'order_by': [{'field': 'name', 'direction': 'desc'},
+                                                {'field': 'id', 'direction': 'asc'}]},
+                                  page, 3)
+        self.assertSameSelect({'order_by': [{'field': 'surname'}, {'field': 'id'}],
+                               'limit': 4, 'offset': 2}, 2, 3)
+        self.assertSameSelect({'filters': [{'name': 'name', 'op': 'like', 'val': 'j%'}]})
+        self.assertEqual(self.manager.select_by_unique('employees', 6),
+                         self.single.select_by_unique('employees', 6))
+
+    def test_pruning(self):
+        sharded = self.manager.shardedModels['employees']
+        queryDict = {'filters': [{'name': 'manager_id', 'op': 'eq', 'val': 2},
+                                 {'name': 'name', 'op': 'eq', 'val': 'jack'}]}
+        self.assertEqual(sharded.shard_names(SearchParameters.from_dictionary(queryDict)),
+                         ['even'])
+        self.assertSameSelect(queryDict)
+        queryDict = {'filters': [{'name': 'manager_id', 'op': 'in', 'val': [1, 3]}]}
+        self.assertEqual(sharded.shard_names(SearchParameters.from_dictionary(queryDict)),
+                         ['odd'])
+        queryDict = {'filters': [{'name': 'manager_id', 'op': 'eq', 'val': 2},
+                                 {'name': 'name', 'op': 'eq', 'val': 'jack'}],
+                     'disjunction': True}
+        self.assertEqual(sharded.shard_names(SearchParameters.from_dictionary(queryDict)),
+                         ['even', 'odd'])
+
+    def test_functions(self):
+        functions = [{'name': 'count', 'field': 'id'}, {'name': 'avg', 'field': 'id'},
+                     {'name': 'min', 'field': 'name'}, {'name': 'max', 'field': 'id'},
+                     {'name': 'sum', 'field': 'manager_id'}]
+        self.assertSameSelect({'functions': functions})
+        self.assertSameSelect({'functions': functions[:2], 'group_by': ['surname'],
+                               'having': [{'name': 'count', 'field': 'id',
+                                           'op': 'gt', 'val': 1}],
+                               'order_by': [{'field': 'count__id', 'direction': 'desc'},
+                                            {'field': 'surname'}]})
+        self.assertSameSelect({'functions': functions[:1], 'group_by': ['surname'],
+                               'limit': 2, 'offset': 1})
+        self.assertRaises(ValueError, self.manager.select, 'employees',
+                          {'functions': functions[:1], 'group_by': ['surname'],
+                           'order_by': [{'field': 'max__id'}]})
+        self.assertSameSelect({'fields': ['surname'], 'distinct': True})
+        self.assertSameSelect({'fields': ['name', 'manager_id'],
+                               'order_by': [{'field': 'name'}, {'field': 'manager_id'}]},
+                              2, 3)
+        self.assertSameSelect({'fields': ['name'], 'limit': 3, 'offset': 2}, 2, 2)
+        self.assertSameSelect({'fields': ['surname'], 'distinct': True,
+                               'limit': 1, 'offset': 1})
+        self.assertRaises(ValueError, self.manager.select, 'employees',
+                          {'functions': [{'name': 'total', 'field': 'id'}]})
+        self.assertRaises(ValueError, self.manager.insert_many, 'employees', [])
+
+
+class TestStartup(unittest.TestCase):
+
+    #: the modules which should only be imported when needed
+    LAZY_MODULES = ('dateutil', 'multiprocessing.pool', 'alchemyjson.utils.export')
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'python -X importtime is not available')
+    def test_lazy_imports(self):
+        # the modules imported by alchemyjson.manager, as listed by importtime
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(alchemyjson.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+        output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c',
+                                          'import alchemyjson.manager'],
+                                         stderr=subprocess.STDOUT, env=env)
+        modules = set()
+        for line in output.decode('utf-8').splitlines():
+            if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+                modules.add(line.split('|')[-1].strip())
+        self.assertIn('alchemyjson.manager', modules)
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, modules)
+
+    def test_prepare(self):
+        registry.forget_model(Meetings)
+        manager = Manager(populate_test_db())
+        manager.add_model(Meetings)
+        self.assertNotIn(Meetings, registry._REGISTRY)
+        manager.prepare()
+        self.assertIn(Meetings, registry._REGISTRY)
+
+    def test_warmup(self):
+        manager = Manager(populate_test_db())
+        manager.add_model(Employees)
+        manager.add_model(Managers)
+        manager.enable_shape_recording()
+        queryDict = {'filters': [{'name': 'name', 'op': 'like', 'val': 'j%'}]}
+        manager.select('employees', queryDict)
+        manager.select('employees', queryDict)
+        manager.select('managers', {'functions': [{'name': 'count', 'field': 'id'}]})
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'shapes.json')
+            self.assertEqual(manager.save_shapes(path), 2)
+            with open(path) as f:
+                shapes = json.load(f)
+            shapes.append(['unknown', {}, 1, 10])
+            with open(path, 'w') as f:
+                json.dump(shapes, f)
+            report = manager.warmup(path, connections=2)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(report), ['connections', 'mappers', 'models', 'shapes'])
+        self.assertEqual(report['connections']['opened'], 2)
+        self.assertEqual(report['models']['count'], 2)
+        self.assertEqual((report['shapes']['count'], report['shapes']['failed']), (3, 1))
+        self.assertTrue(all(step['seconds'] >= 0 for step in report.values()))
+
+
+class TestReflection(unittest.TestCase):
+
+    def setUp(self):
+        self.DB = populate_test_db()
+        self.directory = mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'schema.pickle')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_all_from_database(self):
+        manager = Manager(self.DB)
+        self.assertEqual(sorted(manager.add_all_from_database(exclude=['meetings'],
+                                                              snapshot=self.snapshot)),
+                         ['employees', 'managers'])
+        rsp = manager.select('employees', {'filters': [{'name': 'managers', 'op': 'has',
+                                                        'val': {'name': 'name', 'op': 'eq',
+                                                                'val': 'johnny'}}]})
+        self.assertEqual(rsp['num_results'], 4)
+        statements = []
+        event.listen(self.DB._engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        # the snapshot is used, only the schema fingerprint is queried
+        manager = Manager(self.DB)
+        self.assertEqual(sorted(manager.add_all_from_database(exclude=['meetings'],
+                                                              snapshot=self.snapshot)),
+                         ['employees', 'managers'])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(manager.select_by_unique('managers', 1), {'id': 1, 'name': 'johnny'})
+        # the schema has changed
+        with self.DB._engine.connect() as connection:
+            connection.execute('CREATE TABLE sites (id INTEGER PRIMARY KEY, name VARCHAR)')
+        manager = Manager(self.DB)
+        manager.add_model(Employees)
+        self.assertEqual(sorted(manager.add_all_from_database(exclude=['meetings'],
+                                                              snapshot=self.snapshot)),
+                         ['managers', 'sites'])
+        self.assertEqual(manager.select('sites')['num_results'], 0)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager(populate_test_db(), maxResultsPerPage=2)
+        self.manager.add_model(Employees)
+        self.prefetcher = self.manager.enable_prefetch(workers=1)
+
+    def tearDown(self):
+        self.manager.disable_prefetch()
+
+    def wait_stored(self, stored):
+        for i in range(500):
+            if self.prefetcher.stats()['stored'] >= stored:
+                return
+            time.sleep(0.01)
+        self.fail('the page has not been prefetched')
+
+    def test_next_page(self):
+        queryDict = {'order_by': [{'field': 'name'}]}
+        expected = self.manager._select('employees', queryDict, 2, 2)
+        self.manager.select('employees', queryDict)
+        self.wait_stored(1)
+        self.assertEqual(self.manager.select('employees', queryDict, 2), expected)
+        stats = self.prefetcher.stats()
+        self.assertEqual((stats['hits'], stats['hit_rate'], stats['wasted']), (1, 1., 0))
+        # the last page is not followed by a prefetch
+        self.assertEqual(stats['scheduled'], 1)
+        self.manager.select('employees', queryDict)
+        self.wait_stored(2)
+        self.manager.insert_many('employees', [{'name': 'zoe'}])
+        self.assertEqual(self.manager.select('employees', queryDict, 2)['num_results'], 5)
+        self.assertEqual(self.prefetcher.stats()['wasted'], 1)
+
+    def test_prefetched_equals_live(self):
+        self.manager.add_model(Meetings)
+        add_meetings(self.manager.dbConnection, 4)
+        live = self.manager._select('meetings', {}, 2, 2)
+        self.manager.select('meetings')
+        self.wait_stored(1)
+        prefetched = self.manager.select('meetings', page=2)
+        self.assertEqual(self.prefetcher.stats()['hits'], 1)
+        self.assertEqual(prefetched, live)
+        self.assertEqual(value_types(prefetched), value_types(live))
+
+
+class TestSample(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager(populate_test_db())
+        self.manager.add_model(Employees)
+        self.manager.insert_many('employees', [{'name': 'e{0}'.format(i),
+                                                'surname': 'odd' if i % 2 else 'even'}
+                                               for i in range(1000)])
+        # a gap in the primary keys
+        self.manager.delete('employees', {'filters': [{'name': 'id', 'op': 'gt', 'val': 800}]})
+
+    def sample(self, sample, filters=None):
+        rsp = self.manager.select('employees', {'filters': filters or [], 'sample': sample})
+        self.assertEqual(rsp['num_results'], len(rsp['objects']))
+        return rsp['objects']
+
+    def test_methods(self):
+        filters = [{'name': 'surname', 'op': 'eq', 'val': 'odd'}]
+        for method in (None, 'probe', 'reservoir'):
+            objects = self.sample({'n': 50, 'seed': 42, 'method': method}, filters)
+            self.assertEqual(len(objects), 50)
+            self.assertEqual(len(set(o['id'] for o in objects)), 50)
+            self.assertTrue(all(o['surname'] == 'odd' for o in objects))
+            self.assertEqual(self.sample({'n': 50, 'seed': 42, 'method': method}, filters),
+                             objects)
+            self.assertNotEqual(self.sample({'n': 50, 'seed': 43, 'method': method}, filters),
+                                objects)
+        # fewer matching rows than requested
+        filters = [{'name': 'id', 'op': 'lt', 'val': 30}]
+        for method in ('probe', 'reservoir'):
+            self.assertEqual([o['id'] for o in self.sample({'n': 50, 'method': method},
+                                                           filters)],
+                             list(range(1, 30)))
+        self.assertEqual(self.sample({'n': 5}, [{'name': 'id', 'op': 'gt', 'val': 2000}]), [])
+        self.assertRaises(ValueError, self.sample, {'n': 5, 'method': 'bogus'})
+
+
+class TestHybrids(unittest.TestCase):
+
+    def setUp(self):
+        self.db = populate_test_db()
+        self.manager = Manager(self.db)
+        self.manager.add_model(Teams, name='teams')
+        self.manager.add_model(Employees)
+        self.manager.insert_many('teams', [{'name': 'm{0}'.format(i)} for i in range(5)])
+        self.manager.insert_many('employees', [{'name': 'e', 'manager_id': 2 + i % 3}
+                                               for i in range(7)])
+        self.statements = []
+        event.listen(self.db._engine, 'before_cursor_execute', self.on_execute)
+
+    def tearDown(self):
+        event.remove(self.db._engine, 'before_cursor_execute', self.on_execute)
+        self.db.close()
+
+    def on_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_push_down(self):
+        objects = self.manager.select('teams')['objects']
+        # the count and the select, without a lazy load per team
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual([(o['size'], o['initial']) for o in objects],
+                         [(4, 'j'), (3, 'm'), (2, 'm'), (2, 'm'), (0, 'm'), (0, 'm')])
+        self.assertEqual(self.manager.select_by_unique('teams', 2)['size'], 3)
+        self.assertEqual([o['size'] for o in self.manager.stream('teams')],
+                         [o['size'] for o in objects])
+        self.assertEqual(self.manager.select('teams', {'single': True,
+                                                       'filters': [{'name': 'id', 'op': 'eq',
+                                                                    'val': 3}]})['size'], 2)
+        # the hybrid properties not serialized are not selected
+        del self.statements[:]
+        objects = self.manager.select('teams', {'to_dict': {'exclude': ['size']}})['objects']
+        self.assertNotIn('size', objects[0])
+        self.assertNotIn('count', self.statements[1])
+        objects = self.manager.select('teams', {'to_dict': {'include_hybrids': False}})['objects']
+        self.assertNotIn('initial', objects[0])
+
+    def test_cache_invalidation(self):
+        self.manager.enable_cache()
+        try:
+            self.assertEqual(self.manager.select('teams')['objects'][0]['size'], 4)
+            self.manager.insert_many('employees', [{'name': 'e', 'manager_id': 1}])
+            self.assertEqual(self.manager.select('teams')['objects'][0]['size'], 5)
+            self.assertEqual(self.manager.cache.stats()['hits'], 0)
+        finally:
+            self.manager.disable_cache()
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.db = populate_test_db()
+        self.manager = Manager(self.db)
+        self.manager.add_model(Employees)
+        self.manager.add_model(SlowTeams, name='slow', timeout=0.2)
+        self.manager.insert_many('employees', [{'name': 'e'}] * 1000)
+        self.checkedOut = 0
+        event.listen(self.db._engine, 'checkout', self.on_checkout)
+        event.listen(self.db._engine, 'checkin', self.on_checkin)
+
+    def tearDown(self):
+        event.remove(self.db._engine, 'checkout', self.on_checkout)
+        event.remove(self.db._engine, 'checkin', self.on_checkin)
+        self.db.close()
+
+    def on_checkout(self, *args):
+        self.checkedOut += 1
+
+    def on_checkin(self, *args):
+        self.checkedOut -= 1
+
+    def test_timeout(self):
+        queryDict = {'filters': [{'name': 'name', 'op': 'ne', 'val': 'x'}]}
+        start = time.time()
+        self.assertRaises(QueryTimeout, self.manager.select, 'slow', queryDict)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.checkedOut, 0)
+        queryDict['filters'][0]['val'] = 'y'
+        self.assertRaises(QueryTimeout, self.manager.select, 'slow', queryDict)
+        stats = self.manager.timeout_stats()
+        self.assertEqual(stats['slow']['total'], 2)
+        self.assertEqual(list(stats['slow']['shapes'].values()), [2])
+        # the values compared within junctions are not part of the shape
+        for value in ('x', 'y'):
+            queryDict = {'filters': [{'junk': 'or', 'filters': [
+                {'name': 'name', 'op': 'ne', 'val': value},
+                {'name': 'id', 'op': 'gt', 'val': 0}]}]}
+            self.assertRaises(QueryTimeout, self.manager.select, 'slow', queryDict)
+        shapes = self.manager.timeout_stats()['slow']['shapes']
+        self.assertEqual(sorted(shapes.values()), [2, 2])
+        self.assertNotIn('"x"', ''.join(shapes))
+        # the connection is usable, by statements with or without timeout
+        self.assertEqual(self.manager.select('employees', maxPerPage=2)['num_results'], 1004)
+        self.assertEqual(self.manager.select('slow', {'to_dict': {'exclude': ['triples']}})
+                         ['num_results'], 1)
+        self.assertEqual(self.manager.select('employees', timeout=10)['num_results'], 1004)
+        # the selects sharing a session are subject to the timeouts as well
+        self.assertRaises(QueryTimeout, self.manager.select_many,
+                          [('employees',), ('slow',)])
+        self.assertEqual(self.manager.timeout_stats()['slow']['total'], 5)
+        self.assertEqual(self.checkedOut, 0)
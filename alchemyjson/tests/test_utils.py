@@ -1,8 +1,17 @@
 from contextlib import closing
+import threading
+import time
+from sqlalchemy import event
 from alchemyjson.tests.initializer import populate_test_db
-from alchemyjson.tests.mapping import Employees
-from alchemyjson.utils.helpers import to_dict
+from alchemyjson.tests.mapping import Employees, Managers, Meetings
+from alchemyjson.utils.helpers import to_dict, get_or_create_many, parse_date, \
+    strings_to_dates, strings_to_dates_many, field_kind
+from dateutil.parser import parse as parse_datetime
+import datetime
 from alchemyjson.utils.search import SearchParameters, create_query
+from alchemyjson.utils.cache import SingleFlight
+from alchemyjson.utils.registry import model_info
+from sqlalchemy import Interval
 
 __author__ = 'chiesa'
 
@@ -39,4 +48,148 @@ class TestMain(unittest.TestCase):
             self.assertEqual(e.name,'michael')
             print to_dict(e)
 
+    def test_single_flight(self):
+        flight = SingleFlight()
+        release = threading.Event()
 
+        def call():
+            release.wait()
+            return {'objects': [1, 2]}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', call)))
+                   for _ in range(3)]
+        for t in threads:
+            t.start()
+        while flight.stats()['collapsed'] < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [{'objects': [1, 2]}] * 3)
+        self.assertIsNot(results[0], results[1])
+        self.assertEqual(flight.stats(), {'executed': 1, 'collapsed': 2,
+                                          'in_flight': 0})
+
+    def test_single_flight_late_waiter(self):
+        flight = SingleFlight()
+        calls = []
+        results = {}
+        waiter = threading.Thread(
+            target=lambda: results.update(waiter=flight.do('k', call)))
+
+        class LateLock(object):
+            # runs the waiter once the leader releases the lock after its call
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.after = None
+
+            def __enter__(self):
+                self.lock.acquire()
+
+            def __exit__(self, *args):
+                self.lock.release()
+                after, self.after = self.after, None
+                if after is not None:
+                    after()
+
+        def call():
+            calls.append(1)
+            if len(calls) == 1:
+                flight._lock.after = lambda: (waiter.start(), waiter.join(1))
+            return {'objects': [1]}
+
+        flight._lock = LateLock()
+        results['leader'] = flight.do('k', call)
+        waiter.join()
+        self.assertEqual(results, {'leader': {'objects': [1]},
+                                   'waiter': {'objects': [1]}})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_single_flight_interrupted(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        class Interrupted(BaseException):
+            pass
+
+        def call():
+            release.wait()
+            raise Interrupted()
+
+        errors = []
+
+        def do():
+            try:
+                flight.do('k', call)
+            except BaseException as e:
+                errors.append(type(e))
+        threads = [threading.Thread(target=do) for _ in range(2)]
+        for t in threads:
+            t.start()
+        while flight.stats()['collapsed'] < 1:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [Interrupted] * 2)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_get_or_create_many(self):
+        with closing(self.DB.get_session()) as session:
+            statements = []
+            event.listen(session.get_bind(), 'before_cursor_execute',
+                         lambda *args: statements.append(args[2]))
+            payload = [{'id': '1', 'name': 'michael2',
+                        'manager': {'id': 1, 'name': 'johnny'}},
+                       {'id': 2, 'manager': {'id': 1}},
+                       {'name': 'new', 'manager': {'name': 'boss'}},
+                       {'id': 99, 'name': 'other'}]
+            e1, e2, e3, e4 = get_or_create_many(session, Employees, payload)
+            self.assertEqual(len(statements), 2)
+            self.assertEqual(e1.name, 'michael2')
+            self.assertIs(e1.manager, e2.manager)
+            self.assertIsNone(e3.id)
+            self.assertEqual(e3.manager.name, 'boss')
+            self.assertIsNone(e4.manager_id)
+            session.rollback()
+
+    def test_parse_date(self):
+        for value in ['2015-01-02', '2015-01-02T03:04', '2015-01-02 03:04:05',
+                      '2015-01-02T03:04:05.12', '2015-01-02T03:04:05.123456',
+                      '2015-01-02T03:04:05+01:00', 'Jan 2 2015']:
+            self.assertEqual(parse_date(value), parse_datetime(value))
+        self.assertRaises(ValueError, parse_date, '2015-02-30')
+
+    def test_strings_to_dates_many(self):
+        rows = [{'start': '2015-01-02T03:04:05', 'duration': 60},
+                {'start': '', 'id': 3},
+                {'start': None, 'duration': None}]
+        converted = strings_to_dates_many(Meetings, rows)
+        self.assertEqual(converted, [strings_to_dates(Meetings, r) for r in rows])
+        self.assertEqual(converted[0], {'start': datetime.datetime(2015, 1, 2, 3, 4, 5),
+                                        'duration': datetime.timedelta(seconds=60)})
+        self.assertEqual(rows[1]['start'], '')
+        self.assertRaises(AttributeError, strings_to_dates, Meetings, {'bogus': 1})
+
+    def test_model_info(self):
+        info = model_info(Managers)
+        self.assertIs(model_info(Managers), info)
+        self.assertEqual(info.primary_keys, ['id'])
+        self.assertEqual(list(info.relations), ['employees'])
+        self.assertEqual(info.relations['employees'].model, Employees)
+        self.assertTrue(info.relations['employees'].uselist)
+        self.assertFalse(model_info(Employees).relations['manager'].uselist)
+        self.assertEqual(sorted(model_info(Employees).column_attrs),
+                         ['id', 'manager_id', 'name', 'surname'])
+        self.assertIsInstance(model_info(Meetings).column_types['duration'], Interval)
+
+    def test_field_kind(self):
+        kinds = model_info(Meetings).field_kinds
+        self.assertEqual(field_kind(Meetings, 'start'), 'date')
+        self.assertIsNone(field_kind(Meetings, 'metadata'))
+        self.assertRaises(AttributeError, field_kind, Meetings, 'bogus')
+        self.assertIn('start', kinds)
+        self.assertNotIn('metadata', kinds)
+        self.assertNotIn('bogus', kinds)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Set based insertion and upsertion of rows given as dictionaries.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+from sqlalchemy import and_, or_, bindparam
+from sqlalchemy.inspection import inspect as sqlalchemy_inspect
+from sqlalchemy.sql.expression import ClauseElement
+
+from .helpers import primary_key_names, strings_to_dates_many
+
+__author__ = 'chiesa'
+
+
+def chunks(rows, size):
+    """Yields the items of the iterable `rows` in lists of at most `size`
+    items."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def column_keys(model):
+    """Returns a dictionary mapping the names of the column attributes of
+    `model` to the keys of the corresponding table columns."""
+    return dict((prop.key, prop.columns[0].key)
+                for prop in sqlalchemy_inspect(model).column_attrs)
+
+
+def table_values(model, rows, keys=None):
+    """Returns the list of the dictionaries `rows`, mapping attribute names
+    of `model` to values, converted by
+    :func:`alchemyjson.utils.helpers.strings_to_dates_many` and keyed by table
+    column keys.
+    Raises :exc:`TypeError` if a row has a key which is not a column
+    attribute of `model`.
+    """
+    keys = keys or column_keys(model)
+    result = []
+    for row in strings_to_dates_many(model, rows):
+        values = {}
+        for name, value in row.items():
+            if name not in keys:
+                msg = '{0} has no column named "{1!r}"'.format(model.__name__,
+                                                                name)
+                raise TypeError(msg)
+            values[keys[name]] = value
+        result.append(values)
+    return result
+
+
+def _by_columns(values):
+    """Groups the list of dictionaries `values` by set of keys, dictionaries
+    holding SQL expressions (as the ``CURRENT_TIMESTAMP`` markers) are
+    grouped alone since they cannot be executed in batch."""
+    groups = {}
+    single = []
+    for value in values:
+        if any(isinstance(v, ClauseElement) for v in value.values()):
+            single.append([value])
+        else:
+            groups.setdefault(frozenset(value), []).append(value)
+    return list(groups.values()) + single
+
+
+def insert_rows(session, model, rows):
+    """Inserts the dictionaries `rows` in the table of `model`, with one
+    executemany statement per set of given columns."""
+    table = sqlalchemy_inspect(model).local_table
+    for group in _by_columns(table_values(model, rows)):
+        _insert(session, table, group)
+
+
+def _insert(session, table, group):
+    if len(group) == 1:
+        session.execute(table.insert().values(**group[0]))
+    else:
+        session.execute(table.insert(), group)
+
+
+def _native_insert(dialect):
+    """Returns the dialect specific insert construct supporting
+    ``ON CONFLICT`` if available in the installed SQLAlchemy."""
+    try:
+        if dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect.name == 'sqlite' and dialect.server_version_info >= (3, 24):
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return None
+    except ImportError:
+        return None
+    return insert
+
+
+def check_keys(model, rows, key=None):
+    """Yields the dictionaries `rows`, raising :exc:`ValueError` if one of
+    them has no value for one of the `key` attributes of `model` (defaults
+    to the primary key), or if one of these is not a column attribute.
+    """
+    key = key or primary_key_names(model)
+    keys = column_keys(model)
+    for name in key:
+        if name not in keys:
+            raise ValueError('{0} has no column named {1!r}'.format(
+                model.__name__, name))
+    for index, row in enumerate(rows):
+        for name in key:
+            if name not in row:
+                raise ValueError('row {0:d} has no value for the key column '
+                                 '{1!r}'.format(index, name))
+        yield row
+
+
+def upsert_rows(session, model, rows, key=None):
+    """Inserts the dictionaries `rows` in the table of `model`, updating
+    instead the rows having the same values of the `key` attributes
+    (defaults to the primary key). When several rows share the same key,
+    only the last one is kept.
+    ``INSERT ... ON CONFLICT DO UPDATE`` is used when supported by the
+    database and the SQLAlchemy version, else the existing keys are
+    selected and the rows are split into an insert and an update
+    executemany statements.
+    Raises :exc:`ValueError` before executing any statement if a row has no
+    value for one of the key attributes, see :func:`check_keys`.
+    """
+    rows = list(check_keys(model, rows, key))
+    table = sqlalchemy_inspect(model).local_table
+    keys = column_keys(model)
+    keyColumns = [keys[k] for k in key or primary_key_names(model)]
+    unique = {}
+    for values in table_values(model, rows, keys):
+        unique[tuple(values[k] for k in keyColumns)] = values
+    insert = _native_insert(session.get_bind().dialect)
+    for group in _by_columns(list(unique.values())):
+        if insert is not None:
+            statement = insert(table)
+            updated = dict((c, statement.excluded[c]) for c in group[0]
+                           if c not in keyColumns)
+            if len(group) == 1:
+                statement = statement.values(**group[0])
+            if updated:
+                statement = statement.on_conflict_do_update(
+                    index_elements=keyColumns, set_=updated)
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=keyColumns)
+            session.execute(statement, group if len(group) > 1 else None)
+        else:
+            _upsert_by_select(session, table, keyColumns, group)
+
+
+def _upsert_by_select(session, table, keyColumns, group):
+    columns = [table.c[k] for k in keyColumns]
+    groupKeys = [tuple(v[k] for k in keyColumns) for v in group]
+    if len(columns) == 1:
+        condition = columns[0].in_([k[0] for k in groupKeys])
+    else:
+        condition = or_(*(and_(*(c == v for c, v in zip(columns, k)))
+                          for k in groupKeys))
+    existing = set(tuple(r) for r in
+                   session.execute(table.select().with_only_columns(columns)
+                                   .where(condition)))
+    new = [v for k, v in zip(groupKeys, group) if k not in existing]
+    old = [v for k, v in zip(groupKeys, group) if k in existing]
+    if new:
+        _insert(session, table, new)
+    updated = [c for c in group[0] if c not in keyColumns]
+    if old and updated:
+        # the key columns are bound under other names, the remaining
+        # parameters make the SET clause
+        statement = table.update().\
+            where(and_(*(c == bindparam('key_' + c.key) for c in columns)))
+        params = []
+        for values in old:
+            param = dict((c, values[c]) for c in updated)
+            param.update(('key_' + k, values[k]) for k in keyColumns)
+            params.append(param)
+        session.execute(statement, params)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+"""
+Response cache for :meth:`alchemyjson.manager.Manager.select`.
+
+Responses are stored pickled (and optionally zlib compressed) in a LRU
+bounded both in number of entries and in bytes. Every entry records the
+tables it has been computed from, the cache listens to the SQLAlchemy
+session events and drops the entries depending on a table as soon as
+a session writes to it.
+
+It also provides the background prefetching of responses and the
+single-flight coalescing of identical concurrent selects.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+from copy import deepcopy
+import json
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.exc import NoInspectionAvailable
+from sqlalchemy.inspection import inspect as sqlalchemy_inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+from .helpers import SerializerPlan, get_related_model
+from .registry import model_info
+
+__author__ = 'chiesa'
+
+
+def canonical_query(queryDict):
+    """Returns a string representation of `queryDict` which does not depend
+    on the ordering of its keys, suitable to be used as a cache key.
+    """
+    return json.dumps(queryDict or {}, sort_keys=True, separators=(',', ':'),
+                      default=repr)
+
+
+def query_shape(queryDict):
+    """Returns the canonical representation of `queryDict`, see
+    :func:`canonical_query`, with the values compared by the filters, the
+    limit and the offset replaced by ``"?"``, so that the queries differing
+    only by these values have the same shape.
+    """
+    def strip(filt):
+        if not isinstance(filt, dict):
+            return filt
+        result = {}
+        for key, value in filt.items():
+            if key == 'filters' and filt.get('junk') is not None:
+                value = [strip(f) for f in value]
+            elif key == 'val':
+                value = strip(value) if isinstance(value, dict) else '?'
+            result[key] = value
+        return result
+    shape = dict(queryDict or {})
+    if shape.get('filters'):
+        shape['filters'] = [strip(f) for f in shape['filters']]
+    for key in ('limit', 'offset'):
+        if shape.get(key) is not None:
+            shape[key] = '?'
+    return canonical_query(shape)
+
+
+def model_tables(model):
+    """Returns the set of the names of the tables `model` is mapped to."""
+    return set(t.fullname for t in sqlalchemy_inspect(model).tables)
+
+
+def relation_tables(model, relation):
+    """Returns the set of the names of the tables read when following
+    the relation `relation` of `model`, including association tables.
+    """
+    related = get_related_model(model, relation)
+    if related is None:
+        return set()
+    tables = model_tables(related)
+    prop = getattr(getattr(model, relation), 'property', None)
+    secondary = getattr(prop, 'secondary', None)
+    if secondary is not None:
+        tables.add(secondary.fullname)
+    return tables
+
+
+def expression_tables(expression):
+    """Returns the set of the names of the tables read by the SQL
+    `expression`, including those of its subqueries."""
+    return set(t.fullname for t in find_tables(expression)
+               if getattr(t, 'fullname', None) is not None)
+
+
+def _deep_tables(model, deep, tables):
+    for relation, rdeep in (deep or {}).items():
+        tables.update(relation_tables(model, relation))
+        if isinstance(rdeep, dict):
+            _deep_tables(get_related_model(model, relation), rdeep, tables)
+
+
+def _hybrid_expressions(model):
+    try:
+        return model_info(model).hybrid_expressions
+    except NoInspectionAvailable:
+        return {}
+
+
+def _filter_tables(model, filters, tables):
+    for filt in filters or []:
+        if filt.get('junk') is not None:
+            _filter_tables(model, filt.get('filters'), tables)
+            continue
+        relation = (filt.get('name') or '').split('__')[0]
+        related = get_related_model(model, relation)
+        if related is None:
+            expression = _hybrid_expressions(model).get(relation)
+            if expression is not None:
+                tables.update(expression_tables(expression))
+            continue
+        tables.update(relation_tables(model, relation))
+        argument = filt.get('val')
+        if isinstance(argument, dict) and 'name' in argument:
+            _filter_tables(related, [argument], tables)
+
+
+def query_tables(model, queryDict):
+    """Returns the set of the names of the tables on which the result of
+    selecting `model` with `queryDict` depends: the tables of the model
+    itself, of the relations serialized through ``to_dict.deep``, loaded
+    through ``joinedload``, grouped by in ``group_by`` or projected in
+    ``fields``, of the relations used in ``filters`` and the tables read by
+    the SQL expressions of the hybrid properties selected along with the
+    rows (see :class:`alchemyjson.utils.helpers.SerializerPlan`) or used in
+    ``filters``.
+    """
+    queryDict = queryDict or {}
+    tables = model_tables(model)
+    toDict = queryDict.get('to_dict', {})
+    _deep_tables(model, toDict.get('deep'), tables)
+    for expression in SerializerPlan(model, toDict).columns:
+        tables.update(expression_tables(expression))
+    for relation in queryDict.get('joinedload') or []:
+        tables.update(relation_tables(model, relation))
+    for fieldname in (queryDict.get('group_by') or []) + \
+            (queryDict.get('fields') or []):
+        if '__' in fieldname:
+            tables.update(relation_tables(model, fieldname.split('__')[0]))
+    _filter_tables(model, queryDict.get('filters'), tables)
+    return tables
+
+
+def _written_tables(instances):
+    tables = set()
+    for instance in instances:
+        mapper = sqlalchemy_inspect(instance).mapper
+        tables.update(t.fullname for t in mapper.tables)
+        for prop in mapper.relationships:
+            if prop.secondary is not None:
+                tables.add(prop.secondary.fullname)
+    return tables
+
+
+class SelectCache(object):
+    """A LRU cache of :meth:`select <alchemyjson.manager.Manager.select>`
+    responses with write driven invalidation.
+
+    `maxEntries` and `maxBytes` bound the number of entries and the total
+    size of the stored (possibly compressed) pickled responses, `ttl` is the
+    default time to live in seconds of an entry (``None`` for no expiration)
+    and `compress` whether the pickled responses should be zlib compressed.
+    A hit returns a copy of the stored response, equal to it and of the same
+    types.
+
+    Once :meth:`attach` has been called, the cache listens to the flush,
+    bulk update/delete and commit events of all the SQLAlchemy sessions
+    and invalidates the entries depending on the written tables.
+    """
+
+    def __init__(self, maxEntries=1000, maxBytes=64 * 1024 * 1024, ttl=60,
+                 compress=False):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.compress = compress
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._byTable = {}
+        self._bytes = 0
+        self._clock = 0
+        self._invalidatedAt = {}
+        self._infoKey = ('alchemyjson.cache', id(self))
+        self._attached = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def attach(self):
+        """Starts listening to the SQLAlchemy session events."""
+        if self._attached:
+            return
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_bulk_update', self._after_bulk)
+        event.listen(Session, 'after_bulk_delete', self._after_bulk)
+        event.listen(Session, 'after_commit', self._after_end)
+        event.listen(Session, 'after_soft_rollback', self._after_soft_rollback)
+        self._attached = True
+
+    def detach(self):
+        """Stops listening to the SQLAlchemy session events."""
+        if not self._attached:
+            return
+        event.remove(Session, 'after_flush', self._after_flush)
+        event.remove(Session, 'after_bulk_update', self._after_bulk)
+        event.remove(Session, 'after_bulk_delete', self._after_bulk)
+        event.remove(Session, 'after_commit', self._after_end)
+        event.remove(Session, 'after_soft_rollback', self._after_soft_rollback)
+        self._attached = False
+
+    def token(self):
+        """Returns a token to be passed to :meth:`put`, it must be taken
+        before querying the database so that a response computed while
+        its tables are being written is not stored.
+        """
+        with self._lock:
+            return self._clock
+
+    def get(self, key):
+        """Returns the response stored for `key` or ``None``."""
+        return self._lookup(key, remove=False)
+
+    def pop(self, key):
+        """Returns the response stored for `key` or ``None``, removing the
+        entry."""
+        return self._lookup(key, remove=True)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _lookup(self, key, remove):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, tables, expires = entry
+            if expires is not None and expires < time.time():
+                self._forget(key, entry)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if remove:
+                self._forget(key, entry)
+            else:
+                self._entries[key] = entry
+            self.hits += 1
+        if self.compress:
+            payload = zlib.decompress(payload)
+        return pickle.loads(payload)
+
+    def put(self, key, response, tables, token, ttl=None):
+        """Stores `response` for `key`, `tables` being the names of the
+        tables the response has been computed from and `token` the value
+        returned by :meth:`token` before computing it.
+        `ttl` overrides the default time to live of the cache.
+        Returns whether the response has actually been stored, which it is
+        not if it cannot be pickled.
+        """
+        try:
+            payload = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+        if self.compress:
+            payload = zlib.compress(payload)
+        if self.maxBytes is not None and len(payload) > self.maxBytes:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        tables = frozenset(tables)
+        with self._lock:
+            if self.is_stale(tables, token):
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self._entries[key] = (payload, tables, expires)
+            self._bytes += len(payload)
+            for table in tables:
+                self._byTable.setdefault(table, set()).add(key)
+            while self._entries and (
+                    (self.maxEntries is not None
+                     and len(self._entries) > self.maxEntries) or
+                    (self.maxBytes is not None
+                     and self._bytes > self.maxBytes)):
+                oldKey = next(iter(self._entries))
+                self._forget(oldKey, self._entries.pop(oldKey))
+                self.evictions += 1
+        return True
+
+    def is_stale(self, tables, token):
+        """Returns whether any of `tables` has been invalidated since
+        :meth:`token` returned `token`."""
+        with self._lock:
+            return any(self._invalidatedAt.get(t, -1) > token for t in tables)
+
+    def invalidate_tables(self, tables):
+        """Drops all the entries depending on any of `tables`."""
+        with self._lock:
+            self._clock += 1
+            for table in tables:
+                self._invalidatedAt[table] = self._clock
+                for key in self._byTable.pop(table, ()):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._forget(key, entry)
+                        self.invalidations += 1
+
+    def clear(self):
+        """Drops all the entries."""
+        with self._lock:
+            self._clock += 1
+            for table in self._byTable:
+                self._invalidatedAt[table] = self._clock
+            self._entries.clear()
+            self._byTable.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns a dictionary with the cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        hit_rate=float(self.hits) / lookups if lookups else 0.,
+                        evictions=self.evictions,
+                        expirations=self.expirations,
+                        invalidations=self.invalidations,
+                        entries=len(self._entries),
+                        bytes=self._bytes)
+
+    def _forget(self, key, entry):
+        payload, tables, expires = entry
+        self._bytes -= len(payload)
+        for table in tables:
+            keys = self._byTable.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._byTable[table]
+
+    def mark_written(self, session, tables):
+        """Invalidates `tables` now and once again when `session` commits,
+        so that responses computed in between from the committed state are
+        not kept either.
+        """
+        if not tables:
+            return
+        session.info.setdefault(self._infoKey, set()).update(tables)
+        self.invalidate_tables(tables)
+
+    def _after_flush(self, session, flush_context):
+        self.mark_written(session, _written_tables(list(session.new) +
+                                                   list(session.dirty) +
+                                                   list(session.deleted)))
+
+    def _after_bulk(self, update_context):
+        self.mark_written(update_context.session,
+                          model_tables(update_context.mapper.class_))
+
+    def _after_end(self, session):
+        tables = session.info.pop(self._infoKey, None)
+        if tables:
+            self.invalidate_tables(tables)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        self._after_end(session)
+
+
+class Prefetcher(object):
+    """Fetches responses in advance, as the next page of a listing, in
+    a bounded pool of background threads, and keeps them in a short lived
+    :class:`SelectCache` until they are taken.
+
+    `workers` is the number of threads, `maxPending` the maximum number of
+    scheduled fetches not completed yet (further ones are dropped),
+    `maxEntries`, `maxBytes` and `ttl` bound the prefetched responses, see
+    :class:`SelectCache`. A scheduled fetch is cancelled, or its response
+    discarded, when a table it depends on is written before it is stored,
+    and the stored responses are invalidated as in the :class:`SelectCache`.
+    """
+
+    def __init__(self, workers=2, maxPending=16, maxEntries=256,
+                 maxBytes=16 * 1024 * 1024, ttl=10):
+        self.cache = SelectCache(maxEntries=maxEntries, maxBytes=maxBytes,
+                                 ttl=ttl)
+        self.cache.attach()
+        self.workers = workers
+        self.maxPending = maxPending
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = None
+        self.scheduled = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.discarded = 0
+        self.failed = 0
+        self.stored = 0
+
+    def take(self, key):
+        """Returns the response prefetched for `key`, removing it, or
+        ``None``."""
+        return self.cache.pop(key)
+
+    def schedule(self, key, tables, call):
+        """Schedules the call of `call()` whose response is stored for `key`,
+        `tables` being the names of the tables it depends on. Returns whether
+        it has actually been scheduled, which it is not if `key` is already
+        prefetched or being prefetched, or if too many fetches are pending.
+        """
+        with self._lock:
+            if key in self._pending or key in self.cache:
+                return False
+            if len(self._pending) >= self.maxPending:
+                self.dropped += 1
+                return False
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.workers)
+            self._pending.add(key)
+            self.scheduled += 1
+            token = self.cache.token()
+            self._pool.apply_async(self._run, (key, tables, call, token))
+        return True
+
+    def _run(self, key, tables, call, token):
+        try:
+            if self.cache.is_stale(tables, token):
+                self._count('cancelled')
+                return
+            response = call()
+            if self.cache.put(key, response, tables, token):
+                self._count('stored')
+            else:
+                self._count('discarded')
+        except Exception:
+            self._count('failed')
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def close(self):
+        """Stops the threads and drops the prefetched responses."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._pending.clear()
+        if pool is not None:
+            pool.terminate()
+        self.cache.detach()
+        self.cache.clear()
+
+    def stats(self):
+        """Returns a dictionary with the prefetch counters, where ``hits`` is
+        the number of prefetched responses taken, ``wasted`` the number of
+        fetched responses which have been discarded, evicted, expired or
+        invalidated before being taken, and ``hit_rate`` the ratio of the
+        hits to the stored responses."""
+        cacheStats = self.cache.stats()
+        with self._lock:
+            return dict(scheduled=self.scheduled,
+                        pending=len(self._pending),
+                        dropped=self.dropped,
+                        cancelled=self.cancelled,
+                        failed=self.failed,
+                        stored=self.stored,
+                        hits=cacheStats['hits'],
+                        hit_rate=(float(cacheStats['hits']) / self.stored
+                                  if self.stored else 0.),
+                        wasted=(self.discarded + cacheStats['evictions'] +
+                                cacheStats['expirations'] +
+                                cacheStats['invalidations']),
+                        entries=cacheStats['entries'],
+                        bytes=cacheStats['bytes'])
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent calls: the first caller for a key
+    executes the call while the callers arriving for the same key before it
+    completes wait for it and receive a copy of its result (or its
+    exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key, call):
+        """Returns the result of `call()`, sharing it with the concurrent
+        callers using the same `key`.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.executed += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.collapsed += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return deepcopy(flight.result)
+        removed = False
+        try:
+            result = call()
+            with self._lock:
+                # no waiter can join the flight once it is removed
+                del self._flights[key]
+                removed = True
+                shared = flight.waiters > 0
+            if shared:
+                # the caller is free to modify its own result
+                flight.result = deepcopy(result)
+        except BaseException as exception:
+            # including KeyboardInterrupt and SystemExit, which the waiters
+            # raise as well rather than receiving no result
+            flight.error = exception
+            raise
+        finally:
+            if not removed:
+                with self._lock:
+                    del self._flights[key]
+            flight.done.set()
+        return result
+
+    def stats(self):
+        """Returns a dictionary with the number of executed and collapsed
+        calls and the number of calls currently in flight.
+        """
+        with self._lock:
+            return dict(executed=self.executed,
+                        collapsed=self.collapsed,
+                        in_flight=len(self._flights))
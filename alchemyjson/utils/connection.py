@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Database connections routing the reads to replicas.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm.session import sessionmaker
+
+__author__ = 'chiesa'
+
+
+class RoundRobinPolicy(object):
+    """Chooses the replicas in turn."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def attach(self, replicas):
+        pass
+
+    def choose(self, replicas):
+        with self._lock:
+            return next(self._counter) % len(replicas)
+
+
+class LeastConnectionsPolicy(object):
+    """Chooses the replica with the least connections checked out of its
+    pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkedOut = {}
+
+    def attach(self, replicas):
+        for index, engine in enumerate(replicas):
+            self._checkedOut[index] = 0
+            event.listen(engine, 'checkout', self._counter(index, 1))
+            event.listen(engine, 'checkin', self._counter(index, -1))
+
+    def _counter(self, index, increment):
+        def count(*args):
+            with self._lock:
+                self._checkedOut[index] += increment
+        return count
+
+    def choose(self, replicas):
+        with self._lock:
+            return min(range(len(replicas)),
+                       key=lambda i: (self._checkedOut.get(i, 0), i))
+
+
+def postgresql_replica_lag(engine):
+    """Returns the replication lag in seconds of a PostgreSQL standby."""
+    with engine.connect() as connection:
+        lag = connection.execute(
+            'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+        ).scalar()
+    return float(lag or 0.)
+
+
+class LagAwarePolicy(object):
+    """Chooses the replica with the least replication lag, provided it does
+    not exceed `maxLag` seconds, or else the primary.
+    `lag` is a callable returning the lag in seconds of a replica engine,
+    defaults to :func:`postgresql_replica_lag`, the lags are measured again
+    every `refresh` seconds. A replica whose lag cannot be measured is not
+    chosen.
+    """
+
+    def __init__(self, lag=None, maxLag=5., refresh=1.):
+        self._lag = lag or postgresql_replica_lag
+        self.maxLag = maxLag
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._lags = None
+        self._measured = 0.
+
+    def attach(self, replicas):
+        pass
+
+    def lags(self, replicas):
+        """Returns the list of the last measured lags of the replicas."""
+        with self._lock:
+            if self._lags is None or \
+                    time.time() - self._measured > self.refresh:
+                self._lags = [self._measure(r) for r in replicas]
+                self._measured = time.time()
+            return self._lags
+
+    def _measure(self, engine):
+        try:
+            return self._lag(engine)
+        except Exception:
+            return None
+
+    def choose(self, replicas):
+        lags = [(lag, i) for i, lag in enumerate(self.lags(replicas))
+                if lag is not None and lag <= self.maxLag]
+        return min(lags)[1] if lags else None
+
+
+#: The routing policies by name
+POLICIES = {'round_robin': RoundRobinPolicy,
+            'least_connections': LeastConnectionsPolicy,
+            'lag_aware': LagAwarePolicy}
+
+
+class RoutingConnection(object):
+    """A database connection, as expected by
+    :class:`alchemyjson.manager.Manager`, made of a `primary` engine and
+    a list of `replicas` engines.
+
+    :meth:`get_session` returns sessions on the primary, used for writes,
+    while :meth:`get_read_session` returns sessions on a replica chosen by
+    `policy`, either the name of one of :data:`POLICIES` or an object with
+    the ``attach(replicas)`` and ``choose(replicas)`` methods, the latter
+    returning the index of the chosen replica or ``None`` for the primary.
+    Within :meth:`read_your_writes` the reads of the current thread go to
+    the primary as well.
+    """
+
+    def __init__(self, primary, replicas=(), policy='round_robin'):
+        self.primary = primary
+        self.replicas = list(replicas)
+        if policy in POLICIES:
+            policy = POLICIES[policy]()
+        self.policy = policy
+        self.policy.attach(self.replicas)
+        self._primaryFactory = sessionmaker(bind=primary)
+        self._replicaFactories = [sessionmaker(bind=r) for r in self.replicas]
+        self._local = threading.local()
+
+    def get_session(self):
+        """Returns a new session on the primary."""
+        return self._primaryFactory()
+
+    def get_read_session(self):
+        """Returns a new session on the replica chosen by the policy."""
+        if not self.replicas or getattr(self._local, 'primary', 0):
+            return self._primaryFactory()
+        index = self.policy.choose(self.replicas)
+        if index is None:
+            return self._primaryFactory()
+        return self._replicaFactories[index]()
+
+    @contextmanager
+    def read_your_writes(self):
+        """Returns a context manager within which the reads of the current
+        thread go to the primary."""
+        self._local.primary = getattr(self._local, 'primary', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.primary -= 1
+
+    def close(self):
+        """Disposes the engines."""
+        for engine in [self.primary] + self.replicas:
+            engine.dispose()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Writing of serialized rows to NDJSON or CSV files.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+import csv
+import gzip
+import io
+import json
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+__author__ = 'chiesa'
+
+#: The supported export formats
+FORMATS = ('ndjson', 'csv')
+
+PY2 = str is bytes
+
+
+def _csv_value(value, encoder):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = encoder(value)
+    if PY2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class _Writer(object):
+    """Buffers and writes encoded chunks to a file, counting the bytes."""
+
+    def __init__(self, fileobj, bufferSize):
+        self._fileobj = fileobj
+        self._bufferSize = bufferSize
+        self._chunks = []
+        self._buffered = 0
+        self.bytes = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self.bytes += len(data)
+        if self._buffered >= self._bufferSize:
+            self.flush()
+
+    def flush(self):
+        self._fileobj.write(b''.join(self._chunks))
+        self._chunks = []
+        self._buffered = 0
+
+
+def export_rows(rows, path, format='ndjson', compress=None, fields=None,
+                encoder=None, bufferSize=1024 * 1024):
+    """Writes the dictionaries of the iterable `rows` to the file `path`
+    and returns a dictionary of the form::
+
+        {"rows": 1000000, "bytes": 81000000, "seconds": 12.3,
+         "rows_per_second": 81300.8, "bytes_per_second": 6585365.8}
+
+    where ``bytes`` is the size of the written data before compression.
+
+    `format` is either ``'ndjson'``, one JSON object per line, or ``'csv'``,
+    with a header line naming the columns, which are the `fields` or else the
+    sorted keys of the first row. Nested values of CSV cells are JSON
+    encoded and ``None`` values are written as empty cells.
+    If `compress` is ``True`` the file is gzip compressed, by default it is
+    when `path` ends with ``.gz``.
+    `encoder` is a callable returning the JSON representation of a value,
+    defaults to :func:`json.dumps`.
+    Writes are buffered in chunks of `bufferSize` bytes, so memory does not
+    depend on the number of rows.
+    """
+    if format not in FORMATS:
+        raise ValueError('format must be one of {0}'.format(', '.join(FORMATS)))
+    encoder = encoder or json.dumps
+    if compress is None:
+        compress = path.endswith('.gz')
+    start = time.time()
+    numRows = 0
+    fileobj = gzip.open(path, 'wb') if compress else io.open(path, 'wb')
+    with fileobj:
+        writer = _Writer(fileobj, bufferSize)
+        if format == 'ndjson':
+            for row in rows:
+                writer.write(encoder(row))
+                writer.write(b'\n')
+                numRows += 1
+        else:
+            lines = StringIO()
+            csvWriter = None
+            for row in rows:
+                if csvWriter is None:
+                    fields = fields or sorted(row)
+                    csvWriter = csv.writer(lines, lineterminator='\n')
+                    csvWriter.writerow([_csv_value(f, encoder) for f in fields])
+                csvWriter.writerow([_csv_value(row.get(f), encoder)
+                                    for f in fields])
+                numRows += 1
+                if lines.tell() >= bufferSize:
+                    writer.write(lines.getvalue())
+                    lines = StringIO()
+                    csvWriter = csv.writer(lines, lineterminator='\n')
+            if csvWriter is None and fields:
+                csv.writer(lines, lineterminator='\n').writerow(
+                    [_csv_value(f, encoder) for f in fields])
+            writer.write(lines.getvalue())
+        writer.flush()
+    seconds = time.time() - start
+    return dict(rows=numRows,
+                bytes=writer.bytes,
+                seconds=seconds,
+                rows_per_second=numRows / seconds if seconds else 0.,
+                bytes_per_second=writer.bytes / seconds if seconds else 0.)
@@ -6,28 +6,28 @@
     :license: GNU AGPLv3+ or BSD
 """
 import datetime
-import inspect
+import re
 import uuid
 
-from dateutil.parser import parse as parse_datetime
+from sqlalchemy import and_
+from sqlalchemy import or_
 from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import Interval
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.associationproxy import AssociationProxy
-from sqlalchemy.ext import hybrid
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import ColumnProperty
 from sqlalchemy.orm import RelationshipProperty as RelProperty
 from sqlalchemy.orm.attributes import InstrumentedAttribute
-from sqlalchemy.orm.attributes import QueryableAttribute
 from sqlalchemy.orm.query import Query
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import _BinaryExpression
 from sqlalchemy.sql.expression import ColumnElement
 from sqlalchemy.inspection import inspect as sqlalchemy_inspect
 
+from .registry import model_info
+
 #: Names of attributes which should definitely not be considered relations when
 #: dynamically computing a list of relations of a SQLAlchemy model.
 RELATION_BLACKLIST = ('query', 'query_class', '_sa_class_manager',
@@ -47,6 +47,9 @@ COLUMN_TYPES = (InstrumentedAttribute, hybrid_property)
 #: value of the field.
 CURRENT_TIME_MARKERS = ('CURRENT_TIMESTAMP', 'CURRENT_DATE', 'LOCALTIMESTAMP')
 
+#: The types of the values of date or time fields which are not parsed
+DATE_TYPES = (datetime.date, datetime.time)
+
 
 def partition(l, condition):
     """Returns a pair of lists, the left one containing all elements of `l` for
@@ -89,33 +92,23 @@ def get_columns(model):
     This includes `hybrid attributes`_.
     .. _hybrid attributes: http://docs.sqlalchemy.org/en/latest/orm/extensions/hybrid.html
     """
-    columns = {}
-    for superclass in model.__mro__:
-        for name, column in superclass.__dict__.items():
-            if isinstance(column, COLUMN_TYPES):
-                columns[name] = column
-    return columns
+    return dict(model_info(model).columns)
 
 
 def get_relations(model):
     """Returns a list of relation names of `model` (as a list of strings)."""
-    return [k for k in dir(model)
-            if not (k.startswith('__') or k in RELATION_BLACKLIST)
-            and get_related_model(model, k)]
+    return list(model_info(model).relations)
 
 
 def get_related_model(model, relationname):
     """Gets the class of the model to which `model` is related by the attribute
     whose name is `relationname`.
     """
-    if hasattr(model, relationname):
-        attr = getattr(model, relationname)
-        if hasattr(attr, 'property') \
-                and isinstance(attr.property, RelProperty):
-            return attr.property.mapper.class_
-        if isinstance(attr, AssociationProxy):
-            return get_related_association_proxy_model(attr)
-    return None
+    try:
+        relation = model_info(model).relations.get(relationname)
+    except NoInspectionAvailable:
+        return None
+    return relation.model if relation is not None else None
 
 
 def get_related_association_proxy_model(attr):
@@ -134,7 +127,7 @@ def has_field(model, fieldname):
     """Returns ``True`` if the `model` has the specified field
     or if it has a settable hybrid property for this field name.
     """
-    descriptors_data = sqlalchemy_inspect(model).all_orm_descriptors._data
+    descriptors_data = model_info(model).descriptors
     if fieldname in descriptors_data and hasattr(descriptors_data[fieldname], 'fset'):
         return getattr(descriptors_data[fieldname], 'fset') is not None
     return hasattr(model, fieldname)
@@ -159,21 +152,46 @@ def get_field_type(model, fieldname):
     return fieldtype
 
 
+def field_kind(model, fieldname):
+    """Returns ``'date'`` if the field of `model` with the specified name
+    corresponds to either a :class:`datetime.date` object or a
+    :class:`datetime.datetime` object, ``'interval'`` if it corresponds to a
+    :class:`datetime.timedelta` object and ``None`` otherwise.
+    The result is computed once per model and name of a mapped attribute,
+    so that the names of other attributes, as sent by clients, do not grow
+    the cache.
+    """
+    info = model_info(model)
+    kinds = info.field_kinds
+    try:
+        return kinds[fieldname]
+    except KeyError:
+        pass
+    fieldtype = get_field_type(model, fieldname)
+    if isinstance(fieldtype, (Date, DateTime)):
+        kind = 'date'
+    elif isinstance(fieldtype, Interval):
+        kind = 'interval'
+    else:
+        kind = None
+    if fieldname in info.descriptors:
+        kinds[fieldname] = kind
+    return kind
+
+
 def is_date_field(model, fieldname):
     """Returns ``True`` if and only if the field of `model` with the specified
     name corresponds to either a :class:`datetime.date` object or a
     :class:`datetime.datetime` object.
     """
-    fieldtype = get_field_type(model, fieldname)
-    return isinstance(fieldtype, Date) or isinstance(fieldtype, DateTime)
+    return field_kind(model, fieldname) == 'date'
 
 
 def is_interval_field(model, fieldname):
     """Returns ``True`` if and only if the field of `model` with the specified
     name corresponds to a :class:`datetime.timedelta` object.
     """
-    fieldtype = get_field_type(model, fieldname)
-    return isinstance(fieldtype, Interval)
+    return field_kind(model, fieldname) == 'interval'
 
 
 def assign_attributes(model, **kwargs):
@@ -191,10 +209,7 @@ def assign_attributes(model, **kwargs):
 
 def primary_key_names(model):
     """Returns all the primary keys for a model."""
-    return [key for key, field in inspect.getmembers(model)
-            if isinstance(field, QueryableAttribute)
-            and isinstance(field.property, ColumnProperty)
-            and field.property.columns[0].primary_key]
+    return list(model_info(model).primary_keys)
 
 
 def primary_key_name(model_or_instance):
@@ -217,6 +232,9 @@ def is_like_list(instance, relation):
     A relation may be like a list if, for example, it is a non-lazy one-to-many
     relation, or it is a dynamically loaded one-to-many.
     """
+    known = model_info(type(instance)).relations.get(relation)
+    if known is not None:
+        return known.uselist
     if relation in instance._sa_class_manager:
         return instance._sa_class_manager[relation].property.uselist
     elif hasattr(instance, relation):
@@ -239,11 +257,23 @@ def is_mapped_class(cls):
         return False
 
 
+def to_value(value):
+    """Returns `value` converted as in :func:`to_dict`: :class:`datetime.date`
+    and :class:`datetime.time` objects to their ISO 8601 format and
+    :class:`uuid.UUID` objects to strings, other values are left unchanged.
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
 # This code was adapted from :meth:`elixir.entity.Entity.to_dict` and
 # http://stackoverflow.com/q/1958219/108197.
 def to_dict(instance, deep=None, exclude=None, include=None,
             exclude_relations=None, include_relations=None,
-            include_methods=None, include_hybrids=True):
+            include_methods=None, include_hybrids=True, hybrid_values=None):
     """Returns a dictionary representing the fields of the specified `instance`
     of a SQLAlchemy model.
     The returned dictionary is suitable as an argument to
@@ -274,6 +304,9 @@ def to_dict(instance, deep=None, exclude=None, include=None,
     returned dictionary; `exclude_relations` is similar.
     `include_methods` is a list mapping strings to method names which will
     be called and their return values added to the returned dictionary.
+    `hybrid_values` is a dictionary mapping names of hybrid properties to
+    their values already computed, for instance by the database (see
+    :class:`SerializerPlan`), which are used instead of evaluating them.
     """
     if (exclude is not None or exclude_relations is not None) and \
             (include is not None or include_relations is not None):
@@ -282,25 +315,24 @@ def to_dict(instance, deep=None, exclude=None, include=None,
     instance_type = type(instance)
     columns = []
     try:
-        inspected_instance = sqlalchemy_inspect(instance_type)
-        column_attrs = inspected_instance.column_attrs.keys()
-        descriptors = inspected_instance.all_orm_descriptors.items()
-        if include_hybrids:
-            hybrid_columns = [k for k, d in descriptors
-                              if d.extension_type == hybrid.HYBRID_PROPERTY
-                              and not (deep and k in deep)]
-        else:
-            hybrid_columns = []
-        columns = column_attrs + hybrid_columns
+        info = model_info(instance_type)
     except NoInspectionAvailable:
         return instance
+    column_attrs = info.column_attrs
+    if include_hybrids:
+        hybrid_columns = [k for k in info.hybrids if not (deep and k in deep)]
+    else:
+        hybrid_columns = []
+    columns = column_attrs + hybrid_columns
     # filter the columns based on exclude and include values
     if exclude is not None:
         columns = (c for c in columns if c not in exclude)
     elif include is not None:
         columns = (c for c in columns if c in include)
     # create a dictionary mapping column name to value
-    result = dict((col, getattr(instance, col)) for col in columns
+    hybrid_values = hybrid_values or {}
+    result = dict((col, hybrid_values[col] if col in hybrid_values
+                   else getattr(instance, col)) for col in columns
                   if not (col.startswith('__') or col in COLUMN_BLACKLIST))
     # add any included methods
     if include_methods is not None:
@@ -311,10 +343,8 @@ def to_dict(instance, deep=None, exclude=None, include=None,
     # default. Convert datetime objects to ISO 8601 format, convert UUID
     # objects to hexadecimal strings, etc.
     for key, value in result.items():
-        if isinstance(value, (datetime.date, datetime.time)):
-            result[key] = value.isoformat()
-        elif isinstance(value, uuid.UUID):
-            result[key] = str(value)
+        if isinstance(value, (datetime.date, datetime.time, uuid.UUID)):
+            result[key] = to_value(value)
         elif key not in column_attrs and is_mapped_class(type(value)):
             result[key] = to_dict(value)
     # recursively call _to_dict on each of the `deep` relations
@@ -356,6 +386,65 @@ def to_dict(instance, deep=None, exclude=None, include=None,
     return result
 
 
+class SerializerPlan(object):
+    """The serialization by :func:`to_dict`, with the keyword arguments
+    `kargs`, of the instances of `model` selected by a query.
+
+    The hybrid properties serialized by :func:`to_dict` which have a SQL
+    expression of their own are selected along with the instances as
+    labelled columns (see :meth:`apply`) and read from the rows, instead of
+    being evaluated in Python on every instance, which may load its
+    relations one instance at a time. The other hybrid properties are
+    evaluated in Python.
+    """
+
+    def __init__(self, model, kargs=None):
+        self.kargs = kargs or {}
+        #: the names of the hybrid properties computed by the database
+        self.hybrids = []
+        self.columns = []
+        if not self.kargs.get('include_hybrids', True):
+            return
+        try:
+            info = model_info(model)
+        except NoInspectionAvailable:
+            return
+        deep = self.kargs.get('deep') or {}
+        exclude = self.kargs.get('exclude')
+        include = self.kargs.get('include')
+        for name in info.hybrids:
+            expression = info.hybrid_expressions.get(name)
+            if expression is None or name in deep or \
+                    name.startswith('__') or name in COLUMN_BLACKLIST:
+                continue
+            if exclude is not None and name in exclude:
+                continue
+            if include is not None and name not in include:
+                continue
+            self.hybrids.append(name)
+            self.columns.append(expression)
+
+    def apply(self, query):
+        """Returns `query` selecting the values of :attr:`hybrids` along
+        with the instances."""
+        if not self.columns:
+            return query
+        return query.add_columns(*self.columns)
+
+    def instance(self, row):
+        """Returns the instance of a row of the query returned by
+        :meth:`apply`."""
+        return row[0] if self.columns else row
+
+    def to_dict(self, row):
+        """Returns the dictionary representation of the instance of a row of
+        the query returned by :meth:`apply`."""
+        if not self.columns:
+            return to_dict(row, **self.kargs)
+        return to_dict(row[0], hybrid_values=dict(zip(self.hybrids, row[1:])),
+                       **self.kargs)
+
+
 def evaluate_functions(session, model, functions):
     """Executes each of the SQLAlchemy functions specified in ``functions``, a
     list of dictionaries of the form described below, on the given model and
@@ -453,33 +542,102 @@ def get_or_create(session, model, attrs):
     This method does not commit the changes made to the session; the
     calling function has that responsibility.
     """
+    return get_or_create_many(session, model, [attrs])[0]
+
+
+def get_or_create_many(session, model, attrs_list):
+    """Returns the list of the instances given by :func:`get_or_create` for
+    each dictionary of `attrs_list`.
+    The existing instances of `model` and of the related models nested in
+    the dictionaries are looked up with a single query per model (or per
+    batch of :data:`LOOKUP_BATCH_SIZE` primary keys) rather than one query per
+    dictionary.
+    """
+    lookups = {}
+    for attrs in attrs_list:
+        _collect_primary_keys(model, attrs, lookups)
+    found = {}
+    for lookup_model, keys in lookups.items():
+        found[lookup_model] = _query_by_primary_keys(session, lookup_model,
+                                                     keys)
+    return [_get_or_create_found(model, attrs, found) for attrs in attrs_list]
+
+
+#: The maximum number of primary keys looked up by a single query.
+LOOKUP_BATCH_SIZE = 500
+
+
+def _model_relations(model):
+    return [(rel, relation.model)
+            for rel, relation in model_info(model).relations.items()]
+
+
+def _primary_key(values, pk_names):
+    # the values given by the client may be of another type than the ones
+    # returned by the database, as strings for integers
+    return tuple(None if values[k] is None else u'{0}'.format(values[k])
+                 for k in pk_names)
+
+
+def _collect_primary_keys(model, attrs, lookups):
+    if not isinstance(attrs, dict):
+        return
+    for rel, related_model in _model_relations(model):
+        if rel not in attrs:
+            continue
+        values = attrs[rel] if isinstance(attrs[rel], list) else [attrs[rel]]
+        for value in values:
+            _collect_primary_keys(related_model, value, lookups)
+    pk_names = primary_key_names(model)
+    if all(k in attrs for k in pk_names):
+        pk_values = strings_to_dates(model, dict((k, attrs[k])
+                                                 for k in pk_names))
+        lookups.setdefault(model, {})[_primary_key(pk_values, pk_names)] = \
+            pk_values
+
+
+def _query_by_primary_keys(session, model, keys):
+    pk_names = primary_key_names(model)
+    values = list(keys.values())
+    found = {}
+    for i in range(0, len(values), LOOKUP_BATCH_SIZE):
+        batch = values[i:i + LOOKUP_BATCH_SIZE]
+        if len(pk_names) == 1:
+            field = getattr(model, pk_names[0])
+            condition = field.in_([v[pk_names[0]] for v in batch])
+        else:
+            condition = or_(*(and_(*(getattr(model, k) == v[k]
+                                     for k in pk_names))
+                              for v in batch))
+        for instance in session_query(session, model).filter(condition):
+            key = _primary_key(dict((k, getattr(instance, k))
+                                    for k in pk_names), pk_names)
+            found[key] = instance
+    return found
+
+
+def _get_or_create_found(model, attrs, found):
     # Not a full relation, probably just an association proxy to a scalar
     # attribute on the remote model.
     if not isinstance(attrs, dict):
         return attrs
     # Recurse into nested relationships
-    for rel in get_relations(model):
+    for rel, related_model in _model_relations(model):
         if rel not in attrs:
             continue
         if isinstance(attrs[rel], list):
-            attrs[rel] = [get_or_create(session, get_related_model(model, rel),
-                                        r) for r in attrs[rel]]
+            attrs[rel] = [_get_or_create_found(related_model, r, found)
+                          for r in attrs[rel]]
         else:
-            attrs[rel] = get_or_create(session, get_related_model(model, rel),
-                                       attrs[rel])
+            attrs[rel] = _get_or_create_found(related_model, attrs[rel],
+                                              found)
     # Find private key names
     pk_names = primary_key_names(model)
     attrs = strings_to_dates(model, attrs)
     # If all of the primary keys were included in `attrs`, try to update
-    # an existing row.
+    # the existing row found by the batched lookup.
     if all(k in attrs for k in pk_names):
-        # Determine the sub-dictionary of `attrs` which contains the mappings
-        # for the primary keys.
-        pk_values = dict((k, v) for (k, v) in attrs.items()
-                         if k in pk_names)
-        # query for an existing row which matches all the specified
-        # primary key values.
-        instance = session_query(session, model).filter_by(**pk_values).first()
+        instance = found.get(model, {}).get(_primary_key(attrs, pk_names))
         if instance is not None:
             assign_attributes(instance, **attrs)
             return instance
@@ -488,6 +646,40 @@ def get_or_create(session, model, attrs):
     return model(**attrs)
 
 
+#: Matches the ISO 8601 dates and times without time zone, which are parsed
+#: by :func:`parse_date` without resorting to :mod:`dateutil`.
+ISO_8601 = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                      r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?$')
+
+
+def parse_date(value):
+    """Returns the :class:`datetime.datetime` object represented by the string
+    `value`. Strict ISO 8601 strings without time zone are parsed directly,
+    other strings by :func:`dateutil.parser.parse`.
+    """
+    match = ISO_8601.match(value)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        try:
+            return datetime.datetime(int(year), int(month), int(day),
+                                     int(hour or 0), int(minute or 0),
+                                     int(second or 0),
+                                     int((fraction or '0').ljust(6, '0')))
+        except ValueError:
+            pass
+    # dateutil is slow to import, it is only loaded when needed
+    from dateutil.parser import parse as parse_datetime
+    return parse_datetime(value)
+
+
+def _string_to_date(value):
+    if value.strip() == '':
+        return None
+    elif value in CURRENT_TIME_MARKERS:
+        return getattr(func, value.lower())()
+    return parse_date(value)
+
+
 def strings_to_dates(model, dictionary):
     """Returns a new dictionary with all the mappings of `dictionary` but
     with date strings and intervals mapped to :class:`datetime.datetime` or
@@ -498,19 +690,17 @@ def strings_to_dates(model, dictionary):
     :class:`sqlalchemy.types.Date`, :class:`sqlalchemy.types.DateTime`, or
     :class:`sqlalchemy.Interval`, then the returned dictionary will have the
     corresponding :class:`datetime.datetime` or :class:`datetime.timedelta`
-    Python object as the value of that mapping in place of the string.
+    Python object as the value of that mapping in place of the string,
+    :data:`DATE_TYPES` values being kept as they are.
     This function outputs a new dictionary; it does not modify the argument.
     """
     result = {}
     for fieldname, value in dictionary.items():
-        if is_date_field(model, fieldname) and value is not None:
-            if value.strip() == '':
-                result[fieldname] = None
-            elif value in CURRENT_TIME_MARKERS:
-                result[fieldname] = getattr(func, value.lower())()
-            else:
-                result[fieldname] = parse_datetime(value)
-        elif (is_interval_field(model, fieldname) and value is not None
+        kind = field_kind(model, fieldname)
+        if kind == 'date' and value is not None and \
+                not isinstance(value, DATE_TYPES):
+            result[fieldname] = _string_to_date(value)
+        elif (kind == 'interval' and value is not None
               and isinstance(value, int)):
             result[fieldname] = datetime.timedelta(seconds=value)
         else:
@@ -518,6 +708,36 @@ def strings_to_dates(model, dictionary):
     return result
 
 
+def strings_to_dates_many(model, dictionaries):
+    """Returns the list of the dictionaries returned by
+    :func:`strings_to_dates` for each dictionary of `dictionaries`.
+    The conversion proceeds column by column: the kind of each field is
+    looked up once and each distinct date string of a column is parsed once,
+    :data:`DATE_TYPES` values being kept as they are.
+    """
+    results = [dict(d) for d in dictionaries]
+    fieldnames = set()
+    for result in results:
+        fieldnames.update(result)
+    for fieldname in fieldnames:
+        kind = field_kind(model, fieldname)
+        if kind == 'date':
+            parsed = {}
+            for result in results:
+                value = result.get(fieldname)
+                if value is None or isinstance(value, DATE_TYPES):
+                    continue
+                if value not in parsed:
+                    parsed[value] = _string_to_date(value)
+                result[fieldname] = parsed[value]
+        elif kind == 'interval':
+            for result in results:
+                value = result.get(fieldname)
+                if value is not None and isinstance(value, int):
+                    result[fieldname] = datetime.timedelta(seconds=value)
+    return results
+
+
 def count(session, query):
     """Returns the count of the specified `query`.
     This function employs an optimization that bypasses the
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Reflection of the tables of a database, with a local snapshot of the
+reflected schema so that it is not reflected again as long as the schema
+does not change.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+import hashlib
+import os
+import pickle
+
+import sqlalchemy
+from sqlalchemy import MetaData
+from sqlalchemy.sql import text
+
+__author__ = 'chiesa'
+
+#: The queries listing the schema of the tables, per dialect, whose results
+#: make the schema fingerprint
+FINGERPRINT_QUERIES = {
+    'sqlite': "SELECT type, name, tbl_name, sql FROM sqlite_master "
+              "ORDER BY type, name",
+    'postgresql': "SELECT c.table_name, c.column_name, c.data_type, "
+                  "c.is_nullable, c.ordinal_position, k.constraint_name "
+                  "FROM information_schema.columns c "
+                  "LEFT JOIN information_schema.key_column_usage k "
+                  "ON k.table_schema = c.table_schema "
+                  "AND k.table_name = c.table_name "
+                  "AND k.column_name = c.column_name "
+                  "WHERE c.table_schema = current_schema() "
+                  "ORDER BY 1, 5, 6",
+    'mysql': "SELECT c.table_name, c.column_name, c.column_type, "
+             "c.is_nullable, c.ordinal_position, k.constraint_name "
+             "FROM information_schema.columns c "
+             "LEFT JOIN information_schema.key_column_usage k "
+             "ON k.table_schema = c.table_schema "
+             "AND k.table_name = c.table_name "
+             "AND k.column_name = c.column_name "
+             "WHERE c.table_schema = DATABASE() "
+             "ORDER BY 1, 5, 6",
+}
+
+
+def schema_fingerprint(engine):
+    """Returns a digest of the schema of the tables of `engine` computed by
+    a single catalog query, or ``None`` if the dialect is not supported (see
+    :data:`FINGERPRINT_QUERIES`)."""
+    query = FINGERPRINT_QUERIES.get(engine.dialect.name)
+    if query is None:
+        return None
+    digest = hashlib.sha1()
+    with engine.connect() as connection:
+        for row in connection.execute(text(query)):
+            digest.update(repr(tuple(row)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _table_filter(include, exclude):
+    include = set(include) if include is not None else None
+    exclude = set(exclude or ())
+
+    def only(name, metadata):
+        return (include is None or name in include) and name not in exclude
+    return only
+
+
+def reflect_metadata(engine, include=None, exclude=None, snapshot=None):
+    """Returns a :class:`sqlalchemy.MetaData` holding the reflected tables of
+    `engine`, those named in `include` if given, except those named in
+    `exclude`.
+    If `snapshot` is the path of a file, the metadata is loaded from it when
+    it has been saved for the same schema fingerprint (see
+    :func:`schema_fingerprint`), tables and SQLAlchemy version, else the
+    tables are reflected and the metadata is saved to it.
+    """
+    key = None
+    fingerprint = schema_fingerprint(engine) if snapshot else None
+    if fingerprint is not None:
+        key = (fingerprint, sorted(include) if include is not None else None,
+               sorted(exclude or ()), sqlalchemy.__version__)
+        try:
+            with open(snapshot, 'rb') as f:
+                savedKey, metadata = pickle.load(f)
+            if savedKey == key:
+                return metadata
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError, pickle.UnpicklingError):
+            pass
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=_table_filter(include, exclude))
+    if key is not None:
+        temporary = '{0}.{1}.tmp'.format(snapshot, os.getpid())
+        with open(temporary, 'wb') as f:
+            pickle.dump((key, metadata), f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(snapshot):
+            os.remove(snapshot)
+        os.rename(temporary, snapshot)
+    return metadata
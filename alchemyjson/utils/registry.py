@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the metadata of the mapped models, computed once per model
+instead of being derived from the model class on every query.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+from collections import namedtuple, OrderedDict
+import threading
+
+from sqlalchemy.ext import hybrid
+from sqlalchemy.ext.associationproxy import AssociationProxy
+from sqlalchemy.inspection import inspect as sqlalchemy_inspect
+from sqlalchemy.orm import ColumnProperty, configure_mappers
+from sqlalchemy.orm import RelationshipProperty as RelProperty
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.sql.expression import ColumnElement, SelectBase
+
+__author__ = 'chiesa'
+
+#: A relation of a model: the related model class and whether the relation
+#: is list-like
+Relation = namedtuple('Relation', ('model', 'uselist'))
+
+
+class ModelInfo(object):
+    """The metadata of the mapped class `model`:
+
+    * ``columns``: the dictionary of the column and hybrid attributes, as
+      returned by :func:`alchemyjson.utils.helpers.get_columns`,
+    * ``column_attrs``: the names of the column attributes,
+    * ``primary_keys``: the names of the primary key attributes,
+    * ``relations``: the ordered dictionary mapping the names of the relations
+      (including association proxies) to :class:`Relation` tuples,
+    * ``hybrids``: the names of the hybrid properties,
+    * ``hybrid_expressions``: the dictionary mapping the names of the hybrid
+      properties having a SQL expression of their own to this expression,
+      labelled,
+    * ``descriptors``: the dictionary of all the ORM descriptors,
+    * ``column_types``: the dictionary mapping the names of the column
+      attributes to their SQLAlchemy types,
+    * ``indexes``: the list of the tuples of the names of the indexed columns
+      of the mapped table.
+
+    The mappers are configured beforehand, so that the relations created by
+    backrefs are known.
+    Raises :exc:`sqlalchemy.exc.NoInspectionAvailable` if `model` is not
+    a mapped class.
+    """
+
+    def __init__(self, model):
+        from .helpers import COLUMN_TYPES, RELATION_BLACKLIST
+        mapper = sqlalchemy_inspect(model)
+        configure_mappers()
+        self.model = model
+        self.columns = {}
+        for superclass in model.__mro__:
+            for name, column in superclass.__dict__.items():
+                if isinstance(column, COLUMN_TYPES):
+                    self.columns[name] = column
+        self.column_attrs = list(mapper.column_attrs.keys())
+        self.descriptors = dict(mapper.all_orm_descriptors.items())
+        self.hybrids = [k for k, d in mapper.all_orm_descriptors.items()
+                        if d.extension_type == hybrid.HYBRID_PROPERTY]
+        self.hybrid_expressions = {}
+        for name in self.hybrids:
+            expression = _hybrid_expression(model, name,
+                                            self.descriptors[name])
+            if expression is not None:
+                self.hybrid_expressions[name] = expression
+        self.column_types = dict((prop.key, prop.columns[0].type)
+                                 for prop in mapper.column_attrs)
+        # the hybrid properties are not evaluated on the class, which only
+        # works for those having a SQL expression
+        self.primary_keys = sorted(
+            key for key, field in mapper.all_orm_descriptors.items()
+            if key not in self.hybrids and isinstance(field, QueryableAttribute)
+            and isinstance(field.property, ColumnProperty)
+            and field.property.columns[0].primary_key)
+        self.relations = OrderedDict()
+        for name in dir(model):
+            if name.startswith('__') or name in RELATION_BLACKLIST or \
+                    name in self.hybrids:
+                continue
+            relation = _relation(model, name)
+            if relation is not None:
+                self.relations[name] = relation
+        table = mapper.local_table
+        self.indexes = [tuple(c.key for c in index.columns)
+                        for index in getattr(table, 'indexes', ())]
+        #: the kinds of the fields, see
+        #: :func:`alchemyjson.utils.helpers.field_kind`
+        self.field_kinds = {}
+
+
+def _hybrid_expression(model, name, descriptor):
+    """Returns the SQL expression of the hybrid property `name` of `model`
+    labelled, or None if it has no expression distinct from its Python
+    getter (whose evaluation on the class may not mean the same thing) or if
+    the expression is not a scalar column expression."""
+    expr = getattr(descriptor, 'expr', None)
+    if expr is None or expr is getattr(descriptor, 'fget', None):
+        return None
+    try:
+        expression = getattr(model, name)
+    except Exception:
+        return None
+    if hasattr(expression, '__clause_element__'):
+        expression = expression.__clause_element__()
+    if isinstance(expression, SelectBase):
+        expression = expression.as_scalar()
+    if not isinstance(expression, ColumnElement):
+        return None
+    return expression.label('hybrid_{0}'.format(name))
+
+
+def _relation(model, name):
+    from .helpers import get_related_association_proxy_model
+    attr = getattr(model, name, None)
+    if hasattr(attr, 'property') and isinstance(attr.property, RelProperty):
+        return Relation(attr.property.mapper.class_, attr.property.uselist)
+    if isinstance(attr, AssociationProxy):
+        related = get_related_association_proxy_model(attr)
+        if related is None:
+            return None
+        local_prop = attr.local_attr.prop
+        return Relation(related, isinstance(local_prop, RelProperty)
+                        and local_prop.uselist)
+    return None
+
+
+_REGISTRY = {}
+_LOCK = threading.Lock()
+
+
+def model_info(model):
+    """Returns the :class:`ModelInfo` of `model`, computing it on the first
+    call."""
+    try:
+        return _REGISTRY[model]
+    except KeyError:
+        pass
+    info = ModelInfo(model)
+    with _LOCK:
+        return _REGISTRY.setdefault(model, info)
+
+
+def forget_model(model):
+    """Drops the :class:`ModelInfo` of `model`, to be called if its mapping
+    changes."""
+    with _LOCK:
+        _REGISTRY.pop(model, None)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Random sampling of the primary keys of the rows of a model matching
+a condition, without sorting the whole set of rows.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+import random
+
+from sqlalchemy import Integer, func, literal, select
+from sqlalchemy.inspection import inspect as sqlalchemy_inspect
+from sqlalchemy.sql import text
+from sqlalchemy.sql.util import ClauseAdapter
+
+from .bulk import chunks
+
+__author__ = 'chiesa'
+
+#: The sampling methods, see :func:`sample_keys`
+SAMPLE_METHODS = ('tablesample', 'probe', 'reservoir')
+
+#: The maximum number of primary keys in an ``IN`` clause
+IN_BATCH_SIZE = 500
+
+
+def sample_keys(session, model, condition, n, seed=None, method=None):
+    """Returns the list of the primary key tuples of `n` rows of `model`
+    matching `condition` drawn at random without replacement, or of all
+    the matching rows if there are fewer. The result only depends on `seed`
+    and on the data, if `seed` is given.
+
+    `method` is one of :data:`SAMPLE_METHODS`, by default ``'tablesample'``
+    on PostgreSQL, else ``'probe'`` if the primary key is a single integer
+    column, else ``'reservoir'``:
+
+    * ``'tablesample'`` selects the matching rows of a ``TABLESAMPLE
+      BERNOULLI`` sample of the table, whose size is estimated from the
+      table statistics and increased until it holds at least `n` rows, then
+      draws `n` of them,
+    * ``'probe'`` draws random values between the minimum and the maximum of
+      the primary key and looks up the matching rows having these values,
+      falling back to ``'reservoir'`` when they are too sparse,
+    * ``'reservoir'`` streams the primary keys of the matching rows and keeps
+      a uniform sample of them (reservoir sampling).
+    """
+    if method is not None and method not in SAMPLE_METHODS:
+        raise ValueError('method must be one of {0}'.format(
+            ', '.join(SAMPLE_METHODS)))
+    rng = random.Random(seed)
+    mapper = sqlalchemy_inspect(model)
+    pkColumns = list(mapper.primary_key)
+    query = session.query(*pkColumns).filter(condition)
+    dialect = session.get_bind().dialect.name
+    if method is None:
+        if dialect == 'postgresql' and len(mapper.tables) == 1:
+            method = 'tablesample'
+        elif len(pkColumns) == 1 and isinstance(pkColumns[0].type, Integer):
+            method = 'probe'
+        else:
+            method = 'reservoir'
+    if n <= 0:
+        return []
+    if method == 'tablesample':
+        return tablesample_keys(session, mapper.local_table, pkColumns,
+                                condition, n, rng, seed)
+    if method == 'probe':
+        if len(pkColumns) != 1:
+            raise ValueError('probing requires a single column primary key')
+        keys = probe_keys(query, pkColumns[0], n, rng)
+        if keys is not None:
+            return keys
+    return reservoir_keys(query, pkColumns, n, rng)
+
+
+def reservoir_keys(query, pkColumns, n, rng, batchSize=1000):
+    """Returns a uniform sample of `n` rows of the primary keys `query`,
+    streamed in primary key order."""
+    reservoir = []
+    rows = query.order_by(*pkColumns).yield_per(batchSize)
+    for i, row in enumerate(rows):
+        if i < n:
+            reservoir.append(tuple(row))
+        else:
+            j = rng.randint(0, i)
+            if j < n:
+                reservoir[j] = tuple(row)
+    return reservoir
+
+
+def probe_keys(query, pkColumn, n, rng, rounds=8, minHitRate=0.01):
+    """Returns the keys of `n` rows of the primary keys `query` found by
+    looking up random values of the integer column `pkColumn`, or ``None``
+    if fewer rows have been found after `rounds` rounds of lookups, or if
+    less than `minHitRate` of the looked up values match a row.
+    """
+    low, high = query.with_entities(func.min(pkColumn),
+                                    func.max(pkColumn)).one()
+    if low is None:
+        return []
+    space = high - low + 1
+    probed = set()
+    found = []
+    for i in range(rounds):
+        missing = n - len(found)
+        remaining = space - len(probed)
+        if missing <= 0 or remaining <= 0:
+            break
+        if probed:
+            hitRate = float(len(found)) / len(probed)
+            if hitRate < minHitRate:
+                return None
+            size = int(1.2 * missing / hitRate) + 1
+        else:
+            size = 2 * missing
+        size = min(remaining, max(size, 100))
+        if 2 * size >= remaining:
+            candidates = [c for c in range(low, high + 1) if c not in probed]
+            rng.shuffle(candidates)
+            candidates = candidates[:size]
+        else:
+            candidates = []
+            while len(candidates) < size:
+                candidate = rng.randint(low, high)
+                if candidate not in probed:
+                    probed.add(candidate)
+                    candidates.append(candidate)
+        probed.update(candidates)
+        hits = set()
+        for chunk in chunks(candidates, IN_BATCH_SIZE):
+            hits.update(row[0] for row in query.filter(pkColumn.in_(chunk)))
+        found.extend(c for c in candidates if c in hits)
+    if len(found) >= n:
+        return [(key,) for key in found[:n]]
+    if len(probed) >= space:
+        return [(key,) for key in found]
+    return None
+
+
+def tablesample_keys(session, table, pkColumns, condition, n, rng, seed=None,
+                     oversampling=2.):
+    """Returns the keys of `n` rows drawn from the rows matching `condition`
+    of a ``TABLESAMPLE BERNOULLI`` sample of `table` (PostgreSQL), the
+    sampled percentage being increased until the sample holds `n` matching
+    rows or is the whole table."""
+    from sqlalchemy import tablesample
+    estimate = session.execute(
+        text('SELECT reltuples FROM pg_class WHERE oid = CAST(:t AS regclass)'),
+        {'t': table.fullname}).scalar() or 0
+    percent = (min(100., 100. * oversampling * n / estimate)
+               if estimate > 0 else 100.)
+    if seed is not None:
+        seed = literal(seed)
+    while True:
+        sampled = tablesample(table, func.bernoulli(percent), seed=seed)
+        adapted = ClauseAdapter(sampled).traverse(condition)
+        statement = select([sampled.corresponding_column(c)
+                            for c in pkColumns]).where(adapted)
+        keys = sorted(tuple(row) for row in session.execute(statement))
+        if len(keys) >= n or percent >= 100.:
+            break
+        percent = min(100., percent * max(2., oversampling * n /
+                                          max(len(keys), 1)))
+    if len(keys) > n:
+        keys = rng.sample(keys, n)
+    return keys
@@ -477,9 +477,13 @@ def search(session, model, search_params):
 
 
 def paginated(query, page_num, results_per_page, model_dict_kargs=None,
-              relload=None, num_results=None):
+              relload=None, num_results=None, plan=None):
     start, end, page_num, total_pages, num_results = get_pagination(query, page_num, results_per_page, num_results)
-    objects = [to_dict(x, **(model_dict_kargs or {})) for x in query[start:end]]
+    if plan is not None:
+        objects = [plan.to_dict(x) for x in plan.apply(query)[start:end]]
+    else:
+        objects = [to_dict(x, **(model_dict_kargs or {}))
+                   for x in query[start:end]]
     return dict(page=page_num, objects=objects, total_pages=total_pages,
                 num_results=num_results)
 
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Horizontal sharding of a model across several databases: shard pruning,
+ordered merge of the per shard results and combination of the per shard
+function values.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+import heapq
+
+from sqlalchemy import and_
+
+from .search import Filter
+
+__author__ = 'chiesa'
+
+#: The equality operators whose argument designates a single shard
+EQUALITY_OPERATORS = ('==', 'eq', 'equals', 'equal_to')
+
+
+class ShardedModel(object):
+    """The shards of a model, see
+    :meth:`alchemyjson.manager.Manager.add_model`.
+
+    `connections` is a dictionary mapping the shard names to database
+    connections (objects with a ``get_session`` method, and optionally a
+    ``get_read_session`` one), `field` the name of the attribute the rows
+    are sharded by and `shardKey` a callable returning the name of the shard
+    holding the rows with a given value of `field`, defaults to the
+    identity.
+    """
+
+    def __init__(self, connections, field, shardKey=None):
+        self.connections = connections
+        self.field = field
+        self.shardKey = shardKey or (lambda value: value)
+
+    def shard_names(self, search_params):
+        """Returns the sorted names of the shards which may hold rows
+        matching `search_params`: the filters on the shard field with an
+        equality or ``in`` operator restrict the shards, the others do not.
+        """
+        shards = self._prune(search_params.filters,
+                             search_params.junction is and_)
+        if shards is None:
+            return sorted(self.connections)
+        return sorted(s for s in shards if s in self.connections)
+
+    def _prune(self, filters, conjunction):
+        """Returns the set of the shards of the rows matching `filters`, or
+        None for all the shards."""
+        result = None
+        for filt in filters:
+            if isinstance(filt, Filter):
+                shards = self._filter_shards(filt)
+            else:
+                shards = self._prune(filt.filters, filt.junk is and_)
+            if conjunction:
+                if shards is not None:
+                    result = shards if result is None else result & shards
+            elif shards is None:
+                return None
+            else:
+                result = shards if result is None else result | shards
+        return result
+
+    def _filter_shards(self, filt):
+        if filt.fieldname != self.field or filt.otherfield:
+            return None
+        if filt.operator in EQUALITY_OPERATORS:
+            return set([self.shardKey(filt.argument)])
+        if filt.operator == 'in':
+            return set(self.shardKey(v) for v in filt.argument)
+        return None
+
+
+class SortKey(object):
+    """Orders tuples of values by the corresponding `directions`, either
+    ``'asc'`` or ``'desc'``, ``None`` values coming first in ascending
+    order."""
+
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, direction in zip(self.values, other.values,
+                                   self.directions):
+            if a == b:
+                continue
+            if direction == 'desc':
+                a, b = b, a
+            if a is None:
+                return True
+            if b is None:
+                return False
+            return a < b
+        return False
+
+    def __eq__(self, other):
+        return not self < other and not other < self
+
+
+def merge_sorted(iterables, key):
+    """Merges the iterables, each one sorted by `key`, into a generator of
+    all their items sorted by `key` (a k-way merge), the items of equal key
+    coming in the order of `iterables`."""
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((key(item), index, item, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        itemKey, index, item, iterator = heap[0]
+        yield item
+        for item in iterator:
+            heapq.heapreplace(heap, (key(item), index, item, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _sum(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _min(values):
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+def _max(values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+#: How the per shard values of the functions are combined, ``avg`` is
+#: weighted by the per shard counts of the field
+COMBINERS = {'count': _sum, 'sum': _sum, 'min': _min, 'max': _max,
+             'avg': None}
+
+
+def shard_functions(functions):
+    """Returns the function specifications to be evaluated on every shard
+    so that `functions` can be combined by :func:`combine_functions`:
+    `functions` and the counts of the averaged fields.
+    Raises :exc:`ValueError` for a function which cannot be combined.
+    """
+    result = list(functions)
+    names = set((f['name'], f['field']) for f in functions)
+    for function in functions:
+        if function['name'] not in COMBINERS:
+            raise ValueError('{0} cannot be evaluated across shards'.format(
+                function['name']))
+        if function['name'] == 'avg' and \
+                ('count', function['field']) not in names:
+            names.add(('count', function['field']))
+            result.append({'name': 'count', 'field': function['field']})
+    return result
+
+
+def combine_functions(functions, results):
+    """Combines the per shard `results`, dictionaries mapping
+    ``'<funcname>__<fieldname>'`` to the values of the functions returned
+    by :func:`shard_functions`, into the dictionary of the values of
+    `functions`."""
+    combined = {}
+    for function in functions:
+        name = '{0}__{1}'.format(function['name'], function['field'])
+        if function['name'] == 'avg':
+            countName = 'count__{0}'.format(function['field'])
+            pairs = [(r[name], r[countName]) for r in results
+                     if r[name] is not None and r[countName]]
+            total = sum(c for a, c in pairs)
+            combined[name] = (sum(float(a) * c for a, c in pairs) / total
+                              if total else None)
+        else:
+            combined[name] = COMBINERS[function['name']](
+                [r[name] for r in results])
+    return combined
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Statement timeouts enforced by the database: ``statement_timeout`` on
+PostgreSQL and a progress handler interrupting the statement being executed
+on SQLite.
+
+Created on October 19, 2026
+
+Copyright Alpes Lasers SA, Neuchatel, Switzerland, 2026
+
+@author: chiesa
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+from sqlalchemy import event
+
+__author__ = 'chiesa'
+
+#: The number of SQLite virtual machine instructions between two checks of
+#: the deadline by the progress handler
+SQLITE_PROGRESS_STEPS = 1000
+
+# the key of the connection info telling that a timeout has been set on the
+# connection, to be reset by the next statement executed without deadline
+_INFO_KEY = 'alchemyjson_timeout'
+
+_local = threading.local()
+
+
+class Deadline(object):
+    """The time by which the statements executed by a thread within
+    :func:`deadline` must be done, `timeout` seconds from now."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.at = time.time() + timeout
+        self.active = True
+
+    def remaining(self):
+        """Returns the number of seconds left, negative once expired."""
+        return self.at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def current_deadline():
+    """Returns the :class:`Deadline` of the current thread, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def use_deadline(current):
+    """Within the context, the statements executed by the current thread are
+    subject to the :class:`Deadline` `current` (possibly None), for instance
+    the deadline of the thread which started the current one."""
+    previous = current_deadline()
+    _local.deadline = current
+    try:
+        yield current
+    finally:
+        _local.deadline = previous
+
+
+@contextmanager
+def deadline(timeout):
+    """Within the context, the statements executed by the current thread on
+    the engines prepared by :func:`enforce_timeouts` are aborted by the
+    database once `timeout` seconds have elapsed. Yields the
+    :class:`Deadline`, that of an enclosing context if it expires first.
+    """
+    previous = current_deadline()
+    if previous is not None and previous.at <= time.time() + timeout:
+        yield previous
+        return
+    current = Deadline(timeout)
+    try:
+        with use_deadline(current):
+            yield current
+    finally:
+        current.active = False
+
+
+def enforce_timeouts(engine):
+    """Makes the statements executed on `engine` subject to the deadline of
+    the executing thread (see :func:`deadline`) on PostgreSQL and SQLite,
+    the statements executed on the other databases are not aborted."""
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+def _progress():
+    # the SQLite progress handler, called by the thread executing the
+    # statement, a non zero result interrupts it
+    current = current_deadline()
+    return 1 if current is not None and current.active and \
+        current.expired() else 0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    current = current_deadline()
+    info = conn.info
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        # SET LOCAL only lasts until the end of the transaction, the
+        # remaining time is set before every statement of the deadline
+        if current is not None:
+            cursor.execute('SET LOCAL statement_timeout = {0:d}'.format(
+                max(1, int(current.remaining() * 1000))))
+            info[_INFO_KEY] = True
+        elif info.pop(_INFO_KEY, False):
+            cursor.execute('SET LOCAL statement_timeout TO DEFAULT')
+    elif dialect == 'sqlite':
+        # the handler is a module function, since sqlite3 does not keep
+        # a reference to handlers equal to a previously set one
+        dbapiConnection = conn.connection.connection
+        if current is not None:
+            if not info.get(_INFO_KEY):
+                dbapiConnection.set_progress_handler(_progress,
+                                                     SQLITE_PROGRESS_STEPS)
+                info[_INFO_KEY] = True
+        elif info.pop(_INFO_KEY, False):
+            dbapiConnection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
@@ -37,6 +37,7 @@ from .helpers import evaluate_functions
 from .helpers import get_by
 from .helpers import get_columns
 from .helpers import get_or_create
+from .helpers import get_or_create_many
 from .helpers import get_related_model
 from .helpers import get_relations
 from .helpers import has_field
@@ -374,8 +375,7 @@ class API(ModelView):
         submodel = get_related_model(self.model, relationname)
         if isinstance(toadd, dict):
             toadd = [toadd]
-        for dictionary in toadd or []:
-            subinst = get_or_create(self.session, submodel, dictionary)
+        for subinst in get_or_create_many(self.session, submodel, toadd or []):
             try:
                 for instance in query:
                     getattr(instance, relationname).append(subinst)
@@ -435,7 +435,7 @@ class API(ModelView):
         """
         submodel = get_related_model(self.model, relationname)
         if isinstance(toset, list):
-            value = [get_or_create(self.session, submodel, d) for d in toset]
+            value = get_or_create_many(self.session, submodel, toset)
         else:
             value = get_or_create(self.session, submodel, toset)
         for instance in query:
@@ -896,9 +896,8 @@ class API(ModelView):
 
                 if type(data[col]) == list:
                     # model has several related objects
-                    for subparams in data[col]:
-                        subinst = get_or_create(self.session, submodel,
-                                                subparams)
+                    for subinst in get_or_create_many(self.session, submodel,
+                                                      data[col]):
                         try:
                             getattr(instance, col).append(subinst)
                         except AttributeError: